@@ -2,61 +2,495 @@
 This module contains helper classes and methods to assist with the collection of content
 to be posted to Mastodon and/or Twitter
 """
-# pylint: disable=E1136
+# pylint: disable=E1136,import-outside-toplevel
 
+import codecs
 import configparser
 import hashlib
+import importlib
 import logging
+import multiprocessing
 import os
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from dataclasses import replace
+from html.parser import HTMLParser
+from typing import Callable
+from typing import Dict
 from typing import List
 from typing import Optional
-from urllib.error import URLError
+from typing import Set
+from typing import Tuple
 from urllib.parse import urlsplit
-from urllib.request import urlopen
 
 import praw
 import prawcore.exceptions
 import requests
 from PIL import Image as PILImage
-from bs4 import BeautifulSoup
-from gfycat.client import GfycatClient
-from gfycat.error import GfycatClientError
-from imgurpython import ImgurClient
-from imgurpython.helpers.error import ImgurClientError
+from PIL import ImageOps as PILImageOps
 from praw.models import Submission
 
 from control import Configuration
+from control import HttpCache
+from control import HttpConfig
+from control import ImageTransformConfig
+from control import SubredditConfig
 
 FATAL_TOOTBOT_ERROR = 'Tootbot cannot continue, now shutting down'
+# Reddit listings whose posts can not be matched back to the name of a subreddit
+SPECIAL_SUBREDDITS = {'all', 'popular', 'random', 'randnsfw', 'friends', 'mod'}
+
+
+# Resolvers for sites that MediaAttachment downloads media from through their own APIs or URL
+# schemes, keyed by host name. Sub domains of a host use the same resolver. Resolvers are given as
+# "module:function" and the module is only imported once a link to one of its hosts comes up.
+# Each resolver is called with the LinkedMediaHelper, the CandidatePost and the url to resolve,
+# and returns a list of downloaded MediaFiles.
+MEDIA_RESOLVERS: Dict[str, str] = {
+    'i.redd.it': 'collect:resolve_reddit_image',
+    'i.reddituploads.com': 'collect:resolve_reddit_image',
+    'v.redd.it': 'collect:resolve_reddit_video',
+    'imgur.com': 'collect:resolve_imgur',
+    'gfycat.com': 'collect:resolve_gfycat',
+    'giphy.com': 'collect:resolve_giphy',
+    'streamable.com': 'collect:resolve_streamable',
+}
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.webm')
+# Failures of the Imgur API are recorded against this host, so that Imgur posts are skipped while
+# the API is down
+IMGUR_API_HOST = 'api.imgur.com'
+
+
+def register_resolver(host: str, resolver: str) -> None:
+    """
+    Registers resolver, given as "module:function", for links to host and its sub domains.
+    """
+    MEDIA_RESOLVERS[host.lower()] = resolver
+
+
+def find_resolver(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Finds the resolver registered for the host of url or for the closest parent domain of it.
+
+        Arguments:
+            url (string): link to look up a resolver for
+
+        Returns:
+            host, resolver (Tuple[str, str]): host the resolver is registered for and the resolver,
+            or None if there is no resolver for the url
+    """
+    host = (urlsplit(url).hostname or '').lower()
+    while host:
+        if host in MEDIA_RESOLVERS:
+            return host, MEDIA_RESOLVERS[host]
+        host = host.partition('.')[2]
+    return None
+
+
+# Meta tags that embed pages use to point to their video
+VIDEO_META_PROPERTIES = ('og:video', 'og:video:url', 'og:video:secure_url', 'twitter:player:stream')
+
+
+@dataclass
+class MediaFile:
+    """
+    Dataclass holding details about a downloaded media file
+    """
+    path: str
+    checksum: str
+    size: int
+    perceptual_hash: str = ''
+
+
+@dataclass
+class MediaLimits:
+    """
+    Dataclass holding the limits a Mastodon instance puts on media attachments. A size limit of 0
+    means that size is not limited.
+    """
+    supported_types: Tuple[str, ...]
+    image_size_limit: int
+    video_size_limit: int
+
+    def size_limit(self, content_type: str) -> int:
+        """
+        Returns the maximum size in bytes of a media attachment of type content_type.
+
+        Arguments:
+            content_type (string): MIME type of media attachment
+
+        Returns:
+            size_limit (int): maximum size in bytes, or 0 if size is not limited
+        """
+        if content_type.startswith('video/'):
+            return self.video_size_limit
+        return self.image_size_limit
+
+    def is_supported(self, content_type: str) -> bool:
+        """
+        Checks if media attachments of type content_type can be uploaded. Unknown or generic
+        content types are assumed to be supported, as the instance will work out the actual type
+        of media attachment from its contents.
+
+        Arguments:
+            content_type (string): MIME type of media attachment
+
+        Returns:
+            True if media attachments of type content_type can be uploaded
+        """
+        if not self.supported_types or content_type in ('', 'application/octet-stream'):
+            return True
+        return content_type in self.supported_types
+
+
+@dataclass
+class CandidatePost:
+    """
+    Dataclass holding the details of a reddit submission that tootbot needs to decide if and how
+    to post it. Values are copied from the listing data PRAW has already received, so reading them
+    never causes PRAW to fetch the submission again.
+    """
+    __slots__ = ('id', 'title', 'url', 'shortlink', 'subreddit', 'over_18', 'spoiler',
+                 'stickied', 'is_self', 'is_gallery', 'media', 'gallery_data', 'media_metadata',
+                 'score', 'created_utc')
+    id: str
+    title: str
+    url: str
+    shortlink: str
+    subreddit: str
+    over_18: bool
+    spoiler: bool
+    stickied: bool
+    is_self: bool
+    is_gallery: bool
+    media: Optional[dict]
+    gallery_data: Optional[dict]
+    media_metadata: Optional[dict]
+    score: int
+    created_utc: float
+
+    @classmethod
+    def from_submission(cls, submission: Submission) -> 'CandidatePost':
+        """
+        Creates a CandidatePost from a submission returned in a PRAW listing.
+
+        Arguments:
+            submission (Submission): PRAW Submission object from a listing
+
+        Returns:
+            candidate (CandidatePost): compact copy of the values needed by tootbot
+        """
+        # Using the attribute dict directly, as reading a missing attribute makes PRAW fetch the
+        # whole submission from reddit
+        data = vars(submission)
+        return cls(id=data['id'],
+                   title=data.get('title', ''),
+                   url=data.get('url', ''),
+                   shortlink=submission.shortlink,
+                   subreddit=str(data.get('subreddit', '')).lower(),
+                   over_18=data.get('over_18', False),
+                   spoiler=data.get('spoiler', False),
+                   stickied=data.get('stickied', False),
+                   is_self=data.get('is_self', False),
+                   is_gallery=data.get('is_gallery', False),
+                   media=data.get('media'),
+                   gallery_data=data.get('gallery_data'),
+                   media_metadata=data.get('media_metadata'),
+                   score=data.get('score', 0),
+                   created_utc=data.get('created_utc', 0.0))
+
+    def has_no_media(self) -> bool:
+        """
+        Checks if the post certainly has no media that MediaAttachment could download, because
+        it is a self post or a reddit video that reddit returned no media for.
+        """
+        return self.is_self or ('v.redd.it' in self.url and not self.media)
+
+    def has_known_media(self) -> bool:
+        """
+        Checks if the post links to media on a site MediaAttachment knows how to download from.
+        """
+        if self.is_gallery and self.gallery_data:
+            return True
+        if self.has_no_media():
+            return False
+        return find_resolver(self.url) is not None or \
+            urlsplit(self.url).path.lower().endswith(MEDIA_EXTENSIONS)
+
+
+@dataclass
+class ResolverTiming:
+    """
+    Dataclass holding how often a media resolver was called and how long it took in total
+    """
+    calls: int = 0
+    seconds: float = 0.0
+    media_files: int = 0
+
+
+class MediaSourceParser(HTMLParser):
+    """
+    HTML parser that looks for the url of a media file in <source> and <video> tags and in the
+    video meta tags of a page. Only the first url for which match returns True is kept.
+    """
+
+    def __init__(self, match: Callable[[str], bool]) -> None:
+        super().__init__(convert_charrefs=True)
+        self.match = match
+        self.media_url = ''
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if self.media_url:
+            return
+        attributes = dict(attrs)
+        if tag in ('source', 'video'):
+            candidate = attributes.get('src')
+        elif tag == 'meta' and (attributes.get('property') or attributes.get('name')) in \
+                VIDEO_META_PROPERTIES:
+            candidate = attributes.get('content')
+        else:
+            return
+        if candidate and self.match(candidate):
+            self.media_url = candidate
+
+
+def find_media_url(response: requests.Response, match: Callable[[str], bool],
+                   chunk_size: int) -> str:
+    """
+    Utility method to find the url of a media file in a html page while the page is being
+    downloaded. The rest of the page is not downloaded once a matching url has been found.
+
+        Arguments:
+            response (Response): streamed response for the page
+            match (Callable): returns True for the media url that is looked for
+            chunk_size (int): number of bytes to read at a time
+
+        Returns:
+            media_url (string): url of the media file or an empty string if none was found
+
+        Raises:
+            requests.RequestException: if reading the page fails part way through
+            LookupError: if the page declares an encoding that is not known
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    parser = MediaSourceParser(match)
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        parser.feed(decoder.decode(chunk))
+        if parser.media_url:
+            break
+    return parser.media_url
 
 
 # Function for downloading images from a URL to media folder
-def save_file(img_url: str, file_path: str, logger: logging.Logger) -> Optional[str]:
+def save_file(img_url: str, file_path: str, logger: logging.Logger, http: HttpConfig,
+              max_size: int = 0,
+              content_types: Optional[Tuple[str, ...]] = None,
+              media_limits: Optional[MediaLimits] = None) -> Optional[MediaFile]:
     """
-    Utility method to save a file located at img_url to a file located at filepath
+    Utility method to save a file located at img_url to a file located at filepath.
+    The sha256 checksum and size of the file are worked out while the file is being written.
+    Content type and size are checked on the response headers before the file is downloaded.
 
         Arguments:
             img_url (string): url of imgur image to download
             file_path (string): directory and filename where to save the downloaded image to
             logger (logger): logger to use for logging messages
+            http (HttpConfig): shared session, chunk size and timeouts to use for the download
+            max_size (int): [optional] maximum size in bytes of the file. Downloads of larger files
+                are aborted. 0 means no limit. Default is 0
+            content_types (Tuple[str]): [optional] content types that may be downloaded. None means
+                all content types can be downloaded. Default is None
+            media_limits (MediaLimits): [optional] limits of the Mastodon instance the file will be
+                uploaded to. Files that can not be uploaded are not downloaded. Default is None
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            media_file (MediaFile): path, checksum and size of downloaded image or None if no image
+            was downloaded
     """
-    resp = requests.get(img_url, stream=True)
-    if resp.status_code == 200:
-        with open(file_path, 'wb') as image_file:
-            for chunk in resp:
-                image_file.write(chunk)
-        # Return the path of the image, which is always the same since we
-        # just overwrite images
-        image_file.close()
+    if http.failures.is_blocked(img_url):
+        logger.info('Not downloading %s, it or its site failed recently', img_url)
+        return None
+
+    try:
+        with http.session.get(img_url, stream=True, timeout=http.timeout) as resp:
+            if resp.status_code < 500:
+                # The site answered, so it is up even if this file can not be downloaded
+                http.failures.record_success(img_url)
+            if resp.status_code != 200:
+                logger.error('File failed to download. Status code: %s' % resp.status_code)
+                http.failures.record_failure(img_url, host_failed=resp.status_code >= 500)
+                return None
+
+            content_type = resp.headers.get('content-type', '').split(';')[0].strip().lower()
+            if content_types is not None and content_type not in content_types:
+                logger.error('URL does not point to a valid media file: %s (%s)',
+                             img_url, content_type)
+                http.failures.record_failure(img_url)
+                return None
+
+            if media_limits is not None:
+                if not media_limits.is_supported(content_type):
+                    logger.warning('Not downloading %s, Mastodon does not support %s',
+                                   img_url, content_type)
+                    return None
+                size_limit = media_limits.size_limit(content_type)
+                if size_limit and (not max_size or size_limit < max_size):
+                    max_size = size_limit
+
+            content_length = resp.headers.get('content-length', '')
+            if max_size and content_length.isdigit() and int(content_length) > max_size:
+                logger.error('File at %s is too big to download (%s bytes)', img_url,
+                             content_length)
+                return None
+
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(file_path, 'wb') as image_file:
+                for chunk in resp.iter_content(chunk_size=http.chunk_size):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        break
+                    image_file.write(chunk)
+                    sha256.update(chunk)
+            # Return the path of the image, which is always the same since we
+            # just overwrite images
+            image_file.close()
+    except requests.RequestException as download_error:
+        logger.error('File failed to download: %s', download_error)
+        http.failures.record_failure(img_url, host_failed=True)
+        return None
+
+    if max_size and size > max_size:
+        logger.error('File at %s is too big, download aborted after %s bytes', img_url, size)
+        try:
+            os.remove(file_path)
+        except OSError as remove_error:
+            logger.error('Error while deleting media file: %s', remove_error)
+        return None
+
+    return MediaFile(path=file_path, checksum=sha256.hexdigest(), size=size)
+
+
+def transform_image(file_path: str, max_dimension: int, png_max_size: int, image_format: str,
+                    quality: int) -> str:
+    """
+    Utility method to scale down and re-encode an image before it is uploaded. Metadata such as
+    EXIF tags is not copied to the new image. This method runs in a separate process, so it must
+    not use any state of the main process.
+
+        Arguments:
+            file_path (string): path to downloaded image
+            max_dimension (int): images wider or higher than this many pixels are scaled down
+            png_max_size (int): PNG images larger than this many bytes are converted to
+                image_format
+            image_format (string): format used for converted PNG images, "JPEG" or "WEBP"
+            quality (int): encoder quality used for JPEG and WEBP images
+
+        Returns:
+            file_path (string): path to the new image, or to the original image if it did not need
+            changing or could not be changed. The original image is removed if a new image has
+            been written.
+    """
+    if os.path.splitext(file_path)[1].lower() not in ('.jpg', '.jpeg', '.png', '.webp'):
         return file_path
 
-    logger.error('File failed to download. Status code: %s' % resp.status_code)
-    return None
+    try:
+        with PILImage.open(file_path) as image:
+            source_format = image.format
+            if source_format not in ('JPEG', 'PNG', 'WEBP') or getattr(image, 'is_animated', False):
+                return file_path
+
+            too_large = max(image.size) > max_dimension > 0
+            convert_png = source_format == 'PNG' and os.path.getsize(file_path) > png_max_size
+            has_metadata = 'exif' in image.info
+            if not (too_large or convert_png or has_metadata):
+                return file_path
+
+            target_format = image_format if convert_png else source_format
+            new_image = PILImageOps.exif_transpose(image)
+            if target_format == 'JPEG' and new_image.mode not in ('RGB', 'L'):
+                if 'A' in new_image.getbands() or 'transparency' in new_image.info:
+                    # JPEG can not store transparency, keep image as PNG instead
+                    target_format = source_format
+                else:
+                    new_image = new_image.convert('RGB')
+            if too_large:
+                new_image.thumbnail((max_dimension, max_dimension))
+
+            extension = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}[target_format]
+            new_file_path = os.path.splitext(file_path)[0] + '_transformed' + extension
+            options = {'optimize': True} if target_format == 'PNG' else {'quality': quality}
+            new_image.save(new_file_path, format=target_format, **options)
+    except (OSError, ValueError, KeyError):
+        return file_path
+
+    os.remove(file_path)
+    return new_file_path
+
+
+def perceptual_hash(file_path: str) -> str:
+    """
+    Utility method to work out the difference hash (dHash) of an image. Images that look alike have
+    hashes that only differ in a few bits, even if they have been resized or re-encoded.
+
+        Arguments:
+            file_path (string): path to image
+
+        Returns:
+            perceptual_hash (string): 64 bit hash as hex string, or an empty string if file_path
+            is not an image
+    """
+    try:
+        with PILImage.open(file_path) as image:
+            # Lets the JPEG decoder skip most of the work of decoding large images
+            image.draft('L', (64, 64))
+            pixels = list(image.convert('L').resize((9, 8), PILImage.LANCZOS).getdata())
+    except (OSError, ValueError):
+        return ''
+
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            bits = (bits << 1) | (left > right)
+    return '%016x' % bits
+
+
+def process_image(file_path: str, hash_image: bool,
+                  image_transform: Optional[ImageTransformConfig]) -> Tuple[str, str]:
+    """
+    Utility method to work out the perceptual hash of a downloaded image and then transform it.
+    The hash is worked out before the image is transformed so it stays the same whatever the
+    transform settings are. This method runs in a separate process.
+
+        Arguments:
+            file_path (string): path to downloaded media file
+            hash_image (bool): work out perceptual hash of image if True
+            image_transform (ImageTransformConfig): transform settings, or None to leave the image
+                unchanged
+
+        Returns:
+            file_path, perceptual_hash (Tuple[str, str]): path to the, possibly transformed, image
+            and its perceptual hash. The hash is empty if it was not worked out.
+    """
+    image_hash = ''
+    is_image = os.path.splitext(file_path)[1].lower() in ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+    if hash_image and is_image:
+        image_hash = perceptual_hash(file_path)
+    if image_transform is not None:
+        file_path = transform_image(file_path,
+                                    image_transform.max_dimension,
+                                    image_transform.png_max_size,
+                                    image_transform.image_format,
+                                    image_transform.quality)
+    return file_path, image_hash
 
 
 class RedditHelper:
@@ -103,9 +537,196 @@ class RedditHelper:
             # Read API keys from secret file
             reddit_config.read(config_file)
 
+        self.reddit_client_id = reddit_config['Reddit']['Agent']
+        self.reddit_client_secret = reddit_config['Reddit']['ClientSecret']
         self.reddit_connection = praw.Reddit(user_agent=self.user_agent,
-                                             client_id=reddit_config['Reddit']['Agent'],
-                                             client_secret=reddit_config['Reddit']['ClientSecret'])
+                                             client_id=self.reddit_client_id,
+                                             client_secret=self.reddit_client_secret)
+
+        # PRAW is not thread safe, so each thread fetching subreddits gets its own connection
+        self.thread_local = threading.local()
+        self.thread_local.reddit_connection = self.reddit_connection
+        self.rate_limit_lock = threading.Lock()
+        self.fetch_pool = ThreadPoolExecutor(max_workers=self.reddit_config.fetch_workers)
+
+    def _get_reddit_connection(self) -> praw.Reddit:
+        """
+        _get_reddit_connection returns the reddit connection for the current thread and creates it
+        if needed.
+
+        Returns:
+            reddit_connection (praw.Reddit): reddit connection to be used by the current thread
+        """
+        reddit_connection = getattr(self.thread_local, 'reddit_connection', None)
+        if reddit_connection is None:
+            reddit_connection = praw.Reddit(user_agent=self.user_agent,
+                                            client_id=self.reddit_client_id,
+                                            client_secret=self.reddit_client_secret)
+            self.thread_local.reddit_connection = reddit_connection
+        return reddit_connection
+
+    def _rate_limit_low(self, reddit_connection: praw.Reddit) -> bool:
+        """
+        _rate_limit_low checks the rate limit headers last returned by reddit. If fewer requests
+        are left than there are threads fetching subreddits, this method waits for the rate limit
+        to reset if reddit told us when that will happen.
+
+        Arguments:
+            reddit_connection (praw.Reddit): reddit connection of the current thread
+
+        Returns:
+            True if few requests are left and subreddits should be read one at a time.
+        """
+        limits = reddit_connection.auth.limits
+        remaining = limits.get('remaining')
+        if remaining is None or remaining >= self.reddit_config.fetch_workers:
+            return False
+
+        reset_timestamp = limits.get('reset_timestamp')
+        if reset_timestamp is not None:
+            wait = max(0.0, reset_timestamp - time.time())
+            self.logger.info('Only %s reddit requests left, waiting %.0f seconds for rate limit '
+                             'to reset', remaining, wait)
+            time.sleep(wait)
+        return True
+
+    def get_all_reddit_posts(self, subreddits: List[SubredditConfig]) -> dict:
+        """
+        get_all_reddit_posts reads posts from all subreddits at the same time, using up to
+        fetch_workers threads. Entries in subreddits that share any subreddit are read with a
+        single request for all of their subreddits combined.
+
+        Arguments:
+            subreddits (List[SubredditConfig]): subreddits to collect posts from
+
+        Returns:
+            posts (dict): posts returned by get_reddit_posts for each subreddit, keyed by the
+            hash tags of the subreddit. Entries are in the same order as in subreddits.
+        """
+        fetches = []
+        for group in self._overlapping_subreddits(subreddits):
+            names = [subreddits[index].name for index in group]
+            if len(names) == 1:
+                fetch = self.fetch_pool.submit(self.get_reddit_posts, names[0],
+                                               limit=self.reddit_config.post_limit)
+            else:
+                fetch = self.fetch_pool.submit(self.get_combined_reddit_posts, names,
+                                               limit=self.reddit_config.post_limit)
+            fetches.append((group, fetch))
+
+        results: List[dict] = [{}] * len(subreddits)
+        for group, fetch in fetches:
+            if len(group) == 1:
+                results[group[0]] = fetch.result()
+            else:
+                for index, posts in zip(group, fetch.result()):
+                    results[index] = posts
+        return {subreddit.tags: posts for subreddit, posts in zip(subreddits, results)}
+
+    @staticmethod
+    def _subreddit_names(subreddit: str) -> Set[str]:
+        """
+        _subreddit_names splits a subreddit or multireddit into the names of its subreddits
+
+        Arguments:
+            subreddit (string): name of subreddit or multireddit (e.g. "cats+kittens")
+
+        Returns:
+            names (Set[str]): lower case names of all subreddits in subreddit
+        """
+        return {name.strip().lower() for name in subreddit.split('+') if name.strip()}
+
+    def _overlapping_subreddits(self, subreddits: List[SubredditConfig]) -> List[List[int]]:
+        """
+        _overlapping_subreddits groups entries of subreddits that share at least one subreddit.
+        Entries using reddit's special listings such as "all" or "popular" are never grouped as
+        their posts can not be matched to a subreddit name.
+
+        Arguments:
+            subreddits (List[SubredditConfig]): subreddits to group
+
+        Returns:
+            groups (List[List[int]]): list of groups, each being a sorted list of indexes into
+            subreddits
+        """
+        groups: List[List[int]] = []
+        group_names: List[Set[str]] = []
+        for index, subreddit in enumerate(subreddits):
+            names = self._subreddit_names(subreddit.name)
+            if names & SPECIAL_SUBREDDITS or any('-' in name for name in names):
+                groups.append([index])
+                group_names.append(set())
+                continue
+
+            merged_group = [index]
+            merged_names = set(names)
+            for position in reversed(range(len(groups))):
+                if group_names[position] & names:
+                    merged_group.extend(groups.pop(position))
+                    merged_names |= group_names.pop(position)
+            groups.append(sorted(merged_group))
+            group_names.append(merged_names)
+
+        return sorted(groups)
+
+    def get_combined_reddit_posts(self, subreddits: List[str], limit: int = 10) -> List[dict]:
+        """
+        get_combined_reddit_posts reads posts for several overlapping subreddits / multireddits
+        with one combined listing and then works out which of the posts belong to each of them.
+
+        Arguments:
+            subreddits (List[str]): names of subreddits or multireddits to collect posts from
+            limit (int): maximum number of posts to return for each subreddit (default 10)
+
+        Returns:
+            posts (List[dict]): for each entry in subreddits, a dict of posts as it would have
+            been returned by get_reddit_posts
+        """
+        reddit_connection = self._get_reddit_connection()
+        if self._rate_limit_low(reddit_connection):
+            with self.rate_limit_lock:
+                return self._get_combined_reddit_posts(reddit_connection, subreddits, limit)
+        return self._get_combined_reddit_posts(reddit_connection, subreddits, limit)
+
+    def _get_combined_reddit_posts(self, reddit_connection: praw.Reddit, subreddits: List[str],
+                                   limit: int) -> List[dict]:
+        """
+        _get_combined_reddit_posts reads and filters posts for get_combined_reddit_posts
+
+        Arguments:
+            reddit_connection (praw.Reddit): reddit connection to use
+            subreddits (List[str]): names of subreddits or multireddits to collect posts from
+            limit (int): maximum number of posts to return for each subreddit
+
+        Returns:
+            posts (List[dict]): for each entry in subreddits, a dict of posts
+        """
+        subreddit_names = [self._subreddit_names(subreddit) for subreddit in subreddits]
+        all_names = set().union(*subreddit_names)
+        combined = '+'.join(sorted(all_names))
+        posts: List[dict] = [{} for _ in subreddits]
+        positions = [0] * len(subreddits)
+        self.logger.info('Getting posts from Subreddits: "%s"' % '", "'.join(subreddits))
+        try:
+            for submission in reddit_connection.subreddit(combined).hot(
+                    limit=limit * len(all_names)):
+                candidate = CandidatePost.from_submission(submission)
+                skip = None
+                for index, names in enumerate(subreddit_names):
+                    if candidate.subreddit not in names or positions[index] >= limit:
+                        continue
+                    positions[index] += 1
+                    if skip is None:
+                        skip = self._skip_submission(candidate)
+                    if not skip:
+                        posts[index][candidate.id] = candidate
+
+                if min(positions) >= limit:
+                    break
+        except prawcore.exceptions.ResponseException as reddit_exception:
+            self.logger.warning('Encountered and error getting reddit posts: %s', reddit_exception)
+
+        return posts
 
     def get_reddit_posts(self, subreddit: str, limit: int = 10) -> dict:
         """
@@ -116,51 +737,88 @@ class RedditHelper:
             subreddit (string): name of subreddit (without leading "r/") to collect posts from
             limit (int): maximum number of posts to return (default 10)
 
+        Returns:
+            posts (dict): of posts to subreddit. each entry has a key of subreddit post-id
+        """
+        reddit_connection = self._get_reddit_connection()
+        if self._rate_limit_low(reddit_connection):
+            # Read subreddits one at a time, letting PRAW space out requests until the rate
+            # limit has been reset
+            with self.rate_limit_lock:
+                return self._get_reddit_posts(reddit_connection, subreddit, limit)
+        return self._get_reddit_posts(reddit_connection, subreddit, limit)
+
+    def _get_reddit_posts(self, reddit_connection: praw.Reddit, subreddit: str,
+                          limit: int) -> dict:
+        """
+        _get_reddit_posts reads and filters posts for get_reddit_posts
+
+        Arguments:
+            reddit_connection (praw.Reddit): reddit connection to use
+            subreddit (string): name of subreddit (without leading "r/") to collect posts from
+            limit (int): maximum number of posts to return
+
         Returns:
             posts (dict): of posts to subreddit. each entry has a key of subreddit post-id
         """
         posts = {}
         self.logger.info('Getting posts from Subreddit: "%s"' % subreddit)
-        subreddit_info = self.reddit_connection.subreddit(subreddit)
+        subreddit_info = reddit_connection.subreddit(subreddit)
         try:
             for submission in subreddit_info.hot(limit=limit):
-
-                if submission.over_18 and not self.reddit_config.nsfw_allowed:
-                    # Skip over NSFW posts if they are disabled in the config file
-                    self.logger.info('Skipping %s, it is marked as NSFW', submission.id)
-                    continue
-
-                if submission.is_self and not self.reddit_config.self_posts:
-                    # Skip over NSFW posts if they are disabled in the config file
-                    self.logger.info('Skipping %s, it is a self post', submission.id)
-                    continue
-
-                if submission.spoiler and not self.reddit_config.spoilers:
-                    # Skip over posts marked as spoilers if they are disabled in
-                    # the config file
-                    self.logger.info('Skipping %s, it is marked as a spoiler', submission.id)
-                    continue
-
-                if submission.stickied and not self.reddit_config.stickied_allowed:
-                    self.logger.info('Skipping %s, it is stickied', submission.id)
+                candidate = CandidatePost.from_submission(submission)
+                if self._skip_submission(candidate):
                     continue
 
                 # Create dict
-                posts[submission.id] = submission
+                posts[candidate.id] = candidate
         except prawcore.exceptions.ResponseException as reddit_exception:
             self.logger.warning('Encountered and error getting reddit posts: $%', reddit_exception)
 
         return posts
 
-    def get_caption(self, submission: Submission, max_len: int,
+    def _skip_submission(self, submission: CandidatePost) -> bool:
+        """
+        _skip_submission checks if a submission should be skipped according to the filters in the
+        config file
+
+        Arguments:
+            submission (CandidatePost): reddit post to check
+
+        Returns:
+            True if the submission should be skipped, otherwise False
+        """
+        if submission.over_18 and not self.reddit_config.nsfw_allowed:
+            # Skip over NSFW posts if they are disabled in the config file
+            self.logger.info('Skipping %s, it is marked as NSFW', submission.id)
+            return True
+
+        if submission.is_self and not self.reddit_config.self_posts:
+            # Skip over NSFW posts if they are disabled in the config file
+            self.logger.info('Skipping %s, it is a self post', submission.id)
+            return True
+
+        if submission.spoiler and not self.reddit_config.spoilers:
+            # Skip over posts marked as spoilers if they are disabled in
+            # the config file
+            self.logger.info('Skipping %s, it is marked as a spoiler', submission.id)
+            return True
+
+        if submission.stickied and not self.reddit_config.stickied_allowed:
+            self.logger.info('Skipping %s, it is stickied', submission.id)
+            return True
+
+        return False
+
+    def get_caption(self, submission: CandidatePost, max_len: int,
                     add_hash_tags: str = None, promo_message: str = None) -> str:
         """
         get_caption returns the text to be posted to mastodon. This is determined from the text of
         the reddit submission, if a promo message should be included, and any hash tags
 
         Arguments:
-            submission (Submission): PRAW Submission object for the reddit post we are determining
-            the mastodon toot text for.
+            submission (CandidatePost): reddit post we are determining the mastodon toot text
+            for.
             max_len: (int): The maximum length the text for the mastodon toot can be.
             add_hash_tags (str): additional hash tags to be added to global hash tags defined in
             config file. The hash tags must be comma delimited
@@ -197,81 +855,238 @@ class RedditHelper:
 
 class LinkedMediaHelper:
     """
-    ImgurHelper provides methods to collect data / content from Imgur and Gfycat
+    ImgurHelper provides methods to collect data / content from Imgur and Gfycat. Gfycat pages
+    are scraped directly, so no Gfycat API keys are needed
     """
 
     def __init__(self, config: Configuration,
                  imgur_secrets: str = 'imgur.secret',
-                 gfycat_secrets: str = 'gfycat.secret',
+                 media_limits: Optional[MediaLimits] = None,
                  ):
         self.logger = config.bot.logger
+        self.media_limits = media_limits
+        self.image_size_limit = media_limits.image_size_limit if media_limits else 0
+        self.image_transform = config.media.image_transform
+        self.hash_images = config.media.perceptual_hash_distance > 0
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+        if self.image_transform.enabled and media_limits is not None:
+            # Images that are too big may be scaled down, so don't skip them when downloading. Their
+            # size is checked against image_size_limit again once they have been transformed
+            self.media_limits = replace(media_limits, image_size_limit=0)
         self.save_dir = config.media.folder
+        self.http = config.http
+        self.download_pool = ThreadPoolExecutor(max_workers=config.media.download_workers)
+        self.downloads_per_host = config.media.downloads_per_host
+        self.max_download_size = config.media.max_download_size
+        self.host_limits: Dict[str, threading.BoundedSemaphore] = {}
+        self.host_limits_lock = threading.Lock()
+
+        self.resolvers: Dict[str, Callable] = {}
+        self.resolver_timings: Dict[str, ResolverTiming] = {}
+
+        # The Imgur client is only created once a link to Imgur comes up, so that its library is
+        # not loaded if it is not needed
+        self.imgur_config = self._get_imgur_secrets(imgur_secrets)
+        self._imgur_client = None
+
+    @property
+    def imgur_client(self):
+        """
+        Client for the Imgur API, created on first use.
+        """
+        if self._imgur_client is None:
+            from imgurpython import ImgurClient
+            from imgurpython.helpers.error import ImgurClientError
+            try:
+                self._imgur_client = ImgurClient(self.imgur_config['Imgur']['ClientID'],
+                                                 self.imgur_config['Imgur']['ClientSecret'],
+                                                 )
+            except ImgurClientError as imgur_error:
+                self.logger.error('Error on creating ImgurClient: %s', imgur_error)
+                self.logger.error(FATAL_TOOTBOT_ERROR)
+                sys.exit(1)
+        return self._imgur_client
 
-        try:
-            imgur_config = self._get_imgur_secrets(imgur_secrets)
-            self.imgur_client = ImgurClient(imgur_config['Imgur']['ClientID'],
-                                            imgur_config['Imgur']['ClientSecret'],
-                                            )
+    def resolve(self, reddit_post: CandidatePost, url: str) -> List[Optional[MediaFile]]:
+        """
+        resolve downloads the media that url links to, using the resolver registered for the host
+        of url. Links to other hosts are downloaded directly if they point to an image or video.
+        How long each resolver takes is logged.
 
-            gfycat_config = self._get_gfycat_secrets(gfycat_secrets)
-            self.gfycat_client = GfycatClient(gfycat_config['Gfycat']['ClientID'],
-                                              gfycat_config['Gfycat']['ClientSecret'],
-                                              )
+        Arguments:
+            reddit_post (CandidatePost): reddit post that links to url
+            url (string): link to resolve
 
-        except ImgurClientError as imgur_error:
-            self.logger.error('Error on creating ImgurClient: %s', imgur_error)
-            self.logger.error(FATAL_TOOTBOT_ERROR)
-            sys.exit(1)
-        except GfycatClientError as gfycat_error:
-            self.logger.error('Error on creating GfycatClient: %s', gfycat_error)
-            self.logger.error(FATAL_TOOTBOT_ERROR)
-            sys.exit(1)
+        Returns:
+            media_files (List[MediaFile]): downloaded media
+        """
+        found = find_resolver(url)
+        if found is None:
+            return [self.get_generic_image(url)]
+
+        host, resolver_name = found
+        resolver = self.resolvers.get(resolver_name)
+        if resolver is None:
+            module_name, _, function_name = resolver_name.partition(':')
+            resolver = getattr(importlib.import_module(module_name), function_name)
+            self.resolvers[resolver_name] = resolver
+
+        start = time.monotonic()
+        media_files = resolver(self, reddit_post, url)
+        elapsed = time.monotonic() - start
+
+        timing = self.resolver_timings.setdefault(host, ResolverTiming())
+        timing.calls += 1
+        timing.seconds += elapsed
+        timing.media_files += sum(1 for media_file in media_files if media_file is not None)
+        self.logger.debug('Resolver for %s took %.2f seconds (%s calls, %.2f seconds on average, '
+                          '%s media files)', host, elapsed, timing.calls,
+                          timing.seconds / timing.calls, timing.media_files)
+        return media_files
+
+    def save_files(self, downloads: List[Tuple[str, str]], max_files: int,
+                   check: Optional[Callable[[MediaFile], bool]] = None) -> List[MediaFile]:
+        """
+        save_files downloads up to max_files files at the same time. Downloads are tried in the
+        order given until max_files have succeeded, or all downloads have been tried.
 
-    def _get_gfycat_secrets(self, gfycat_secrets: str) -> configparser.ConfigParser:
+        Arguments:
+            downloads (List[Tuple[str, str]]): url and file path of each file to download
+            max_files (int): maximum number of files to return
+            check (Callable): [optional] called for each downloaded file. Files for which this
+                returns False are not returned.
+
+        Returns:
+            media_files (List[MediaFile]): downloaded files in the same order as in downloads
         """
-        _get_gfycat_secrets checks if the Gfycat api secrets file exists.
-        - If the file exists, this methods reads the the files and returns the secrets in as a dict.
-        - If the file doesn't exist it asks the user over stdin to supply these values and then
-          saves them into the gfycat_secrets file
+        media_files = []
+        position = 0
+        while len(media_files) < max_files and position < len(downloads):
+            batch = downloads[position:position + max_files - len(media_files)]
+            position += len(batch)
+            saved = self.download_pool.map(lambda download: self._save_file(*download), batch)
+            for media_file in saved:
+                if media_file is not None and (check is None or check(media_file)):
+                    media_files.append(media_file)
+        return media_files
+
+    def _save_file(self, url: str, file_path: str,
+                   content_types: Optional[Tuple[str, ...]] = None) -> Optional[MediaFile]:
+        """
+        _save_file downloads a single file while making sure that no more than
+        downloads_per_host files are being downloaded from the same host at the same time. Files
+        larger than max_download_size, or that do not meet media_limits, are not downloaded.
 
         Arguments:
-            gfycat_secrets (string): file name of secrets file for API credentials
+            url (string): url of file to download
+            file_path (string): directory and filename where to save the downloaded file to
+            content_types (Tuple[str]): [optional] content types that may be downloaded. None means
+                all content types can be downloaded. Default is None
 
         Returns:
-            imgur_config (dict): Dictionary containing the client id and client secret needed to
-            login to Gfycat
+            media_file (MediaFile): downloaded file or None if no file was downloaded
         """
+        host = urlsplit(url).hostname
+        with self.host_limits_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.downloads_per_host)
+            host_limit = self.host_limits[host]
+        with host_limit:
+            return save_file(url, file_path, self.logger, self.http,
+                             max_size=self.max_download_size, content_types=content_types,
+                             media_limits=self.media_limits)
+
+    def process_images(self, media_files: List[Optional[MediaFile]]) -> List[Optional[MediaFile]]:
+        """
+        process_images works out perceptual hashes of downloaded images and scales down and
+        re-encodes them, as set in the config file. Images are processed by a pool of separate
+        processes, so CPU heavy work does not block the main process. The checksums of the
+        originally downloaded images are kept so checking for duplicates is not affected.
 
-        if not os.path.exists(gfycat_secrets):
-            self.logger.warning('Gfycat API keys not found. (See wiki if you need help).')
+        Arguments:
+            media_files (List[MediaFile]): downloaded media files, may contain None entries
 
-            # Whitespaces are stripped from input: https://stackoverflow.com/a/3739939
-            gfycat_client_id = ''.join(input("[ .. ] Enter Gfycat client ID: ").split())
-            gfycat_client_secret = ''.join(input("[ .. ] Enter Gfycat client secret: ").split())
-            # Make sure authentication is working
+        Returns:
+            media_files (List[MediaFile]): media files with perceptual hash added, and path and size
+            updated for any image that has been transformed, in the same order as before
+        """
+        image_transform = self.image_transform if self.image_transform.enabled else None
+        if image_transform is None and not self.hash_images:
+            return media_files
+
+        if self.process_pool is None:
+            # Worker processes are started fresh rather than forked, as forking a process that
+            # already runs threads can leave locks held in the child
+            self.process_pool = ProcessPoolExecutor(max_workers=self.image_transform.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+
+        processes = []
+        for media_file in media_files:
+            if media_file is None:
+                processes.append(None)
+                continue
             try:
-                gfycat_client = GfycatClient(gfycat_client_id, gfycat_client_secret)
+                processes.append(self.process_pool.submit(process_image,
+                                                          media_file.path,
+                                                          self.hash_images,
+                                                          image_transform))
+            except BrokenProcessPool as pool_error:
+                self.logger.error('Error while processing image %s: %s',
+                                  media_file.path, pool_error)
+                self.process_pool = None
+                processes.append(None)
+                break
+        processes.extend([None] * (len(media_files) - len(processes)))
+
+        processed_files = []
+        for media_file, process in zip(media_files, processes):
+            if process is not None:
+                try:
+                    new_path, image_hash = process.result()
+                    if new_path != media_file.path:
+                        self.logger.info('Transformed image %s to %s', media_file.path, new_path)
+                    media_file = replace(media_file, path=new_path,
+                                         size=os.path.getsize(new_path),
+                                         perceptual_hash=image_hash)
+                    media_file = self._check_image_size(media_file)
+                except BrokenProcessPool as pool_error:
+                    # A worker died, for example running out of memory. The pool can not be used
+                    # any more, so a new one is started for the next images
+                    self.logger.error('Error while processing image %s: %s',
+                                      media_file.path, pool_error)
+                    self.process_pool = None
+                except Exception as process_error:  # pylint: disable=broad-except
+                    # Any error in a worker, like PIL refusing a decompression bomb, only loses
+                    # the processing of that image
+                    self.logger.error('Error while processing image %s: %s',
+                                      media_file.path, process_error)
+            processed_files.append(media_file)
+        return processed_files
+
+    def _check_image_size(self, media_file: MediaFile) -> Optional[MediaFile]:
+        """
+        _check_image_size removes an image that is still larger than the instance accepts after
+        it has been transformed.
 
-                # If this call doesn't work, it'll throw an ImgurClientError
-                gfycat_client.query_gfy('oddyearlyhorsefly')
-                # It worked, so save the keys to a file
-                gfycat_config = configparser.ConfigParser()
-                gfycat_config['Gfycat'] = {'ClientID': gfycat_client_id,
-                                           'ClientSecret': gfycat_client_secret,
-                                           }
-                with open(gfycat_secrets, 'w') as file:
-                    gfycat_config.write(file)
-                file.close()
-            except GfycatClientError as gfycat_error:
-                self.logger.error('Error while logging into Gfycat: %s', gfycat_error)
-                self.logger.error(FATAL_TOOTBOT_ERROR)
-                sys.exit(1)
-        else:
-            # Read API keys from secret file
-            gfycat_config = configparser.ConfigParser()
-            gfycat_config.read(gfycat_secrets)
+        Arguments:
+            media_file (MediaFile): processed media file
 
-        return gfycat_config
+        Returns:
+            media_file (MediaFile): media_file, or None if it was too large and has been removed
+        """
+        is_image = os.path.splitext(media_file.path)[1].lower() in \
+            ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+        if not self.image_transform.enabled or not is_image or \
+                not 0 < self.image_size_limit < media_file.size:
+            return media_file
+
+        self.logger.warning('Image %s is too big to upload (%s bytes, limit is %s bytes)',
+                            media_file.path, media_file.size, self.image_size_limit)
+        try:
+            os.remove(media_file.path)
+        except OSError as remove_error:
+            self.logger.error('Error while deleting media file: %s', remove_error)
+        return None
 
     def _get_imgur_secrets(self, imgur_secrets: str) -> configparser.ConfigParser:
         """
@@ -294,6 +1109,8 @@ class LinkedMediaHelper:
             # Whitespaces are stripped from input: https://stackoverflow.com/a/3739939
             imgur_client_id = ''.join(input("[ .. ] Enter Imgur client ID: ").split())
             imgur_client_secret = ''.join(input("[ .. ] Enter Imgur client secret: ").split())
+            from imgurpython import ImgurClient
+            from imgurpython.helpers.error import ImgurClientError
             # Make sure authentication is working
             try:
                 imgur_client = ImgurClient(imgur_client_id, imgur_client_secret)
@@ -319,7 +1136,7 @@ class LinkedMediaHelper:
 
         return imgur_config
 
-    def get_imgur_image(self, img_url: str, max_images: int = 4) -> List[str]:
+    def get_imgur_image(self, img_url: str, max_images: int = 4) -> List[MediaFile]:
         """
         get_imgur_image downloads images from imgur.
 
@@ -328,7 +1145,7 @@ class LinkedMediaHelper:
             max_images: maximum number of images to download and process, Defaults to 4
 
         Returns:
-            file_paths (string): path to downloaded image or None if no image was downloaded
+            media_files (List[MediaFile]): downloaded images
         """
 
         # Working demo of regex: https://regex101.com/r/G29uGl/2
@@ -345,7 +1162,7 @@ class LinkedMediaHelper:
         image_urls = self._get_image_urls(img_url, imgur_id)
 
         # Download and process individual images (up to max_images)
-        imgur_paths = []
+        downloads = []
         for image_url in image_urls:
             # If the URL is a GIFV or MP4 link, change it to the GIF version
             file_extension = os.path.splitext(image_url)[-1].lower()
@@ -356,21 +1173,17 @@ class LinkedMediaHelper:
                 file_extension = '.gif'
                 image_url = image_url.replace('.mp4', '.gif')
 
-            # Download the image
             file_path = self.save_dir + '/' + imgur_id + '_' + str(
-                len(imgur_paths)) + file_extension
+                len(downloads)) + file_extension
             self.logger.info('Downloading Imgur image at URL %s to %s', image_url, file_path)
-            current_image = save_file(image_url, file_path, self.logger)
-
-            # Imgur will sometimes return a single-frame thumbnail
-            # instead of a GIF, so we need to check for this
-            if file_extension != '.gif' or self._check_imgur_gif(file_path):
-                imgur_paths.append(current_image)
+            downloads.append((image_url, file_path))
 
-            if len(imgur_paths) == max_images:
-                break
+        # Imgur will sometimes return a single-frame thumbnail
+        # instead of a GIF, so we need to check for this
+        def is_not_thumbnail(media_file: MediaFile) -> bool:
+            return not media_file.path.endswith('.gif') or self._check_imgur_gif(media_file.path)
 
-        return imgur_paths
+        return self.save_files(downloads, max_images, check=is_not_thumbnail)
 
     def _get_image_urls(self, img_url: str, imgur_id: str) -> List[str]:
         """
@@ -384,6 +1197,15 @@ class LinkedMediaHelper:
             imgur_urls: List of urls to images of Imgur post identified byr imgur_id
         """
         image_urls = []
+        if self.http.failures.is_blocked(img_url, host=IMGUR_API_HOST):
+            self.logger.info('Not asking Imgur about %s, it or the Imgur API failed recently',
+                             img_url)
+            return image_urls
+        entry, fresh = self.http.cache.lookup(img_url)
+        if fresh:
+            self.logger.debug('Using cached Imgur image urls for %s', img_url)
+            return entry['value']
+        from imgurpython.helpers.error import ImgurClientError
         try:
             if any(s in img_url for s in ('/a/', '/gallery/')):  # Gallery links
                 self.logger.info('Imgur link points to gallery: %s', img_url)
@@ -392,8 +1214,13 @@ class LinkedMediaHelper:
                     image_urls.append(image.link)
             else:  # Single image
                 image_urls = [self.imgur_client.get_image(imgur_id).link]
+            self.http.failures.record_success(img_url, host=IMGUR_API_HOST)
+            self.http.cache.store(img_url, image_urls)
         except ImgurClientError as imgur_error:
             self.logger.error('Could not get information from imgur: %s', imgur_error)
+            host_failed = imgur_error.status_code is None or imgur_error.status_code >= 500
+            self.http.failures.record_failure(img_url, host_failed=host_failed,
+                                              host=IMGUR_API_HOST)
         return image_urls
 
     def _check_imgur_gif(self, file_path: str) -> bool:
@@ -421,7 +1248,7 @@ class LinkedMediaHelper:
 
         return True
 
-    def get_gfycat_image(self, img_url: str) -> Optional[str]:
+    def get_gfycat_image(self, img_url: str) -> Optional[MediaFile]:
         """
         get_gfycat_image downloads full resolution images from gfycat.
 
@@ -429,25 +1256,28 @@ class LinkedMediaHelper:
             img_url (string): url of gfycat image to download
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            media_file (MediaFile): downloaded image or None if no image was downloaded
         """
         gfycat_url = ""
         file_path = self.save_dir + '/'
+        if self.http.failures.is_blocked(img_url):
+            self.logger.info('Not downloading %s, it or its site failed recently', img_url)
+            return None
         try:
             gfycat_name = os.path.basename(urlsplit(img_url).path)
-            response = requests.get(img_url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'lxml')
-            for tag in soup.find_all("source", src=True):
-                src = tag['src']
-                if "giant" in src and "mp4" in src:
-                    gfycat_url = src
+            gfycat_url = self._find_page_media(img_url, lambda src: 'giant' in src and 'mp4' in src)
+            self.http.failures.record_success(img_url)
             file_path += gfycat_name + '.mp4'
-        except (requests.ConnectionError,
-                requests.Timeout,
-                requests.HTTPError,
-                GfycatClientError) as gfycat_error:
+        except requests.RequestException as gfycat_error:
             self.logger.error('Error downloading Gfycat link: %s', gfycat_error)
+            response = getattr(gfycat_error, 'response', None)
+            self.http.failures.record_failure(
+                img_url, host_failed=response is None or response.status_code >= 500)
+            return None
+        except LookupError as encoding_error:
+            # The page declared an encoding that Python does not know
+            self.logger.error('Error reading Gfycat page %s: %s', img_url, encoding_error)
+            self.http.failures.record_failure(img_url)
             return None
 
         if gfycat_url == '':
@@ -455,9 +1285,82 @@ class LinkedMediaHelper:
             return None
 
         self.logger.info('Downloading Gfycat at URL %s to %s', gfycat_url, file_path)
-        return save_file(gfycat_url, file_path, self.logger)
+        return self._save_file(gfycat_url, file_path)
+
+    def get_streamable_video(self, img_url: str) -> Optional[MediaFile]:
+        """
+        get_streamable_video downloads the mp4 video that a streamable page embeds.
+
+        Arguments:
+            img_url (string): url of streamable page
+
+        Returns:
+            media_file (MediaFile): downloaded video or None if no video was downloaded
+        """
+        if self.http.failures.is_blocked(img_url):
+            self.logger.info('Not downloading %s, it or its site failed recently', img_url)
+            return None
+        try:
+            video_url = self._find_page_media(
+                img_url, lambda src: '.mp4' in urlsplit(src).path.lower())
+            self.http.failures.record_success(img_url)
+        except requests.RequestException as streamable_error:
+            self.logger.error('Error downloading Streamable link: %s', streamable_error)
+            response = getattr(streamable_error, 'response', None)
+            self.http.failures.record_failure(
+                img_url, host_failed=response is None or response.status_code >= 500)
+            return None
+        except LookupError as encoding_error:
+            # The page declared an encoding that Python does not know
+            self.logger.error('Error reading Streamable page %s: %s', img_url, encoding_error)
+            self.http.failures.record_failure(img_url)
+            return None
+
+        if video_url == '':
+            self.logger.debug('No video found on Streamable page %s', img_url)
+            return None
+
+        video_id = os.path.basename(urlsplit(img_url).path)
+        file_path = self.save_dir + '/' + video_id + '_streamable.mp4'
+        self.logger.info('Downloading Streamable video at URL %s to %s', video_url, file_path)
+        return self._save_file(video_url, file_path, content_types=('video/mp4',))
+
+    def _find_page_media(self, url: str, match: Callable[[str], bool]) -> str:
+        """
+        _find_page_media returns the first media url on the page at url for which match returns
+        True. Media urls are kept in the http cache. Once a cached media url is out of date the
+        page is requested again, but only downloaded and searched again if it has changed.
+
+        Arguments:
+            url (string): url of the page
+            match (Callable): returns True for the media url that is looked for
+
+        Returns:
+            media_url (string): media url found on the page or an empty string if none was found
 
-    def get_reddit_image(self, img_url: str) -> str:
+        Raises:
+            requests.RequestException: if the page could not be requested
+        """
+        entry, fresh = self.http.cache.lookup(url)
+        if fresh:
+            self.logger.debug('Using cached media url for %s', url)
+            return entry['value']
+
+        with self.http.session.get(url, headers=HttpCache.conditional_headers(entry),
+                                   stream=True, timeout=self.http.timeout) as response:
+            if response.status_code < 500:
+                # The site answered, so it is up even if the page is not there
+                self.http.failures.record_success(url)
+            if response.status_code == 304 and entry is not None:
+                self.logger.debug('%s has not changed', url)
+                self.http.cache.refresh(url)
+                return entry['value']
+            response.raise_for_status()
+            media_url = find_media_url(response, match, self.http.chunk_size)
+        self.http.cache.store(url, media_url, response.headers)
+        return media_url
+
+    def get_reddit_image(self, img_url: str) -> Optional[MediaFile]:
         """
         get_reddit_image downloads full resolution images from i.reddit or reddituploads.
 
@@ -465,7 +1368,7 @@ class LinkedMediaHelper:
             img_url (string): url of imgur image to download
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            media_file (MediaFile): downloaded image or None if no image was downloaded
         """
         file_name = os.path.basename(urlsplit(img_url).path)
         file_extension = os.path.splitext(img_url)[1].lower()
@@ -482,22 +1385,23 @@ class LinkedMediaHelper:
                          file_path,
                          file_extension,
                          )
-        return save_file(img_url, file_path, self.logger)
+        return self._save_file(img_url, file_path)
 
-    def get_reddit_gallery(self, reddit_post: Submission, max_images: int = 4) -> List[str]:
+    def get_reddit_gallery(self, reddit_post: CandidatePost,
+                           max_images: int = 4) -> List[MediaFile]:
         """
         get_reddit_gallery downloads up to max_images images from a reddit gallery post and returns
-        a List of file_paths downloaded images
+        a List of the downloaded images
 
         Arguments:
-            reddit_post (reddit_post):  reddit post / submission object
+            reddit_post (CandidatePost):  reddit post
             max_images (int): [optional] maximum number of images to download. Default is 4
 
         Returns:
-            file_paths (List[str]) a list of the paths to downloadeed files. If no images have been
+            media_files (List[MediaFile]) a list of the downloaded files. If no images have been
             downloaded, and empty list will be returned.
         """
-        file_paths = []
+        downloads = []
         for item in sorted(reddit_post.gallery_data['items'], key=lambda x: x['id']):
             media_id = item['media_id']
             meta = reddit_post.media_metadata[media_id]
@@ -507,30 +1411,27 @@ class LinkedMediaHelper:
                 save_path = self.save_dir + '/' + media_id + '.' + meta['m'].split('/')[1]
                 self.logger.info('Gallery file_path, source: %s - %s', save_path, source['u'])
                 self.logger.debug('A[%4dx%04d] %s' % (source['x'], source['y'], source['u']))
-                file_paths.append(save_file(source['u'], save_path, self.logger))
+                downloads.append((source['u'], save_path))
 
-                if len(file_paths) == max_images:
-                    break
+        return self.save_files(downloads, max_images)
 
-        return file_paths
-
-    def get_reddit_video(self, reddit_post: Submission) -> str:
+    def get_reddit_video(self, reddit_post: CandidatePost) -> Optional[MediaFile]:
         """
         get_reddit_video downloads full resolution video from i.reddit or reddituploads.
 
         Arguments:
-            reddit_post (reddit_post): reddit post / submission object
+            reddit_post (CandidatePost): reddit post
 
         Returns:
-            file_path (string): path to downloaded video or None if no image was downloaded
+            media_file (MediaFile): downloaded video or None if no video was downloaded
         """
         # Get URL for MP4 version of reddit video
         video_url = reddit_post.media['reddit_video']['fallback_url']
         file_path = self.save_dir + '/' + reddit_post.id + '.mp4'
         self.logger.info('Downloading Reddit video at URL %s to %s', video_url, file_path)
-        return save_file(video_url, file_path, self.logger)
+        return self._save_file(video_url, file_path)
 
-    def get_giphy_image(self, img_url: str) -> Optional[str]:
+    def get_giphy_image(self, img_url: str) -> Optional[MediaFile]:
         """
         get_giphy_image downloads full or low resolution image from giphy
 
@@ -538,7 +1439,7 @@ class LinkedMediaHelper:
             img_url (string): url of giphy image to download
 
         Returns:
-            file_path (string): path to downloaded image or None if no image was downloaded
+            media_file (MediaFile): downloaded image or None if no image was downloaded
         """
         # Working demo of regex: https://regex101.com/r/o8m1kA/2
         regex = r"https?://((?:.*)giphy\.com/media/|giphy.com/gifs/|i.giphy.com/)(.*-)?(\w+)(/|\n)"
@@ -552,12 +1453,12 @@ class LinkedMediaHelper:
         # Download the MP4 version of the GIF
         giphy_url = 'https://media.giphy.com/media/' + giphy_id + '/giphy.mp4'
         file_path = self.save_dir + '/' + giphy_id + 'giphy.mp4'
-        giphy_file = save_file(giphy_url, file_path, self.logger)
+        giphy_file = self._save_file(giphy_url, file_path)
         self.logger.info('Downloading Giphy at URL %s to %s', giphy_url, file_path)
 
         return giphy_file
 
-    def get_generic_image(self, img_url: str) -> Optional[str]:
+    def get_generic_image(self, img_url: str) -> Optional[MediaFile]:
         """
         get_generic_image downloads image or video from a generic url to a media file.
 
@@ -565,7 +1466,7 @@ class LinkedMediaHelper:
             img_url (string): url to image or video file
 
         Returns:
-            file_path (string): path to downloaded video or None if no image was downloaded
+            media_file (MediaFile): downloaded video or None if no video was downloaded
         """
         # First check if URL starts with http:// or https://
         regex = r"^https?://"
@@ -574,24 +1475,13 @@ class LinkedMediaHelper:
             self.logger.info('Post link is not a full link: %s', img_url)
             return None
 
-        # Check if URL is an image or MP4 file, based on the MIME type
+        # Only download the file if it is an image or MP4 file, based on the MIME type
+        # returned when requesting it
         image_formats = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/mp4')
-        try:
-            img_site = urlopen(img_url)
-        except (URLError, UnicodeEncodeError) as url_error:
-            self.logger.error('Error while opening URL %s', url_error)
-            return None
-
-        meta = img_site.info()
-        if meta["content-type"] not in image_formats:
-            self.logger.error('URL does not point to a valid image file: %s', img_url)
-            return None
-
-        # URL appears to be an image, so download it
         file_name = os.path.basename(urlsplit(img_url).path)
         file_path = self.save_dir + '/' + file_name
         self.logger.info('Downloading file at URL %s to %s', img_url, file_path)
-        return save_file(img_url, file_path, self.logger)
+        return self._save_file(img_url, file_path, content_types=image_formats)
 
 
 class MediaAttachment:
@@ -600,24 +1490,23 @@ class MediaAttachment:
     s reddit post to be shared on Mastodon or Twitter
     """
 
-    def __init__(self, reddit_post: Submission, image_helper: LinkedMediaHelper,
+    def __init__(self, reddit_post: CandidatePost, image_helper: LinkedMediaHelper,
                  logger: logging.Logger):
 
         self.media_paths = {}
+        self.perceptual_hashes = {}
         self.reddit_post = reddit_post
         self.media_url = self.reddit_post.url
         self.image_helper = image_helper
         self.logger = logger
 
-        for media_path in self.get_media():
-            self.logger.info('Media path for checksum calculation: %s', media_path)
-            if media_path is not None:
-                sha256 = hashlib.sha256()
-                with open(media_path, "rb") as media_file:
-                    # Read and update hash string value in blocks of 4K
-                    for byte_block in iter(lambda: media_file.read(4096), b""):
-                        sha256.update(byte_block)
-                self.media_paths[sha256.hexdigest()] = media_path
+        for media_file in self.image_helper.process_images(self.get_media()):
+            if media_file is not None:
+                self.logger.info('Media %s (%s bytes) has checksum: %s',
+                                 media_file.path, media_file.size, media_file.checksum)
+                self.media_paths[media_file.checksum] = media_file.path
+                if media_file.perceptual_hash:
+                    self.perceptual_hashes[media_file.checksum] = media_file.perceptual_hash
 
     def destroy(self):
         """
@@ -633,6 +1522,7 @@ class MediaAttachment:
             self.logger.error('Error while deleting media file: %s', delete_error)
 
         self.media_paths = {}
+        self.perceptual_hashes = {}
         self.media_url = None
 
     def destroy_one_attachment(self, checksum: str):
@@ -648,11 +1538,12 @@ class MediaAttachment:
                 os.remove(media_path)
                 self.logger.info('Deleted media file at %s', media_path)
             self.media_paths.pop(checksum)
+            self.perceptual_hashes.pop(checksum, None)
         except OSError as delete_error:
             self.logger.error('Error while deleting media file: %s', delete_error)
 
     # Function for obtaining static images and GIFs from popular image hosts
-    def get_media(self) -> List[str]:
+    def get_media(self) -> List[Optional[MediaFile]]:
         """
         Determines which method to call depending on which site the media_url is pointing to.
         """
@@ -661,30 +1552,65 @@ class MediaAttachment:
             self.logger.info('Media folder not found, created new folder: %s',
                              self.image_helper.save_dir)
 
-        file_paths = []
+        media_files = []
 
         # Download and save the linked image
-        if hasattr(self.reddit_post, "is_gallery"):
+        if self.reddit_post.is_gallery and self.reddit_post.gallery_data:
             self.logger.debug('%s is a gallery post', self.reddit_post.id)
-            file_paths.extend(self.image_helper.get_reddit_gallery(self.reddit_post))
-        elif any(s in self.media_url for s in ('i.redd.it', 'i.reddituploads.com')):
-            file_paths.append(self.image_helper.get_reddit_image(self.media_url))
-        elif 'v.redd.it' in self.media_url and not self.reddit_post.media:
-            self.logger.error('Reddit API returned no media for this URL: %s', self.media_url)
-        elif 'v.redd.it' in self.media_url:
-            file_paths.append(self.image_helper.get_reddit_video(self.reddit_post))
+            media_files.extend(self.image_helper.get_reddit_gallery(self.reddit_post))
+        else:
+            media_files.extend(self.image_helper.resolve(self.reddit_post, self.media_url))
 
-        elif 'imgur.com' in self.media_url:
-            self.logger.info('Reddit post %s links to Imgur', self.reddit_post.id)
-            file_paths.extend(self.image_helper.get_imgur_image(self.media_url))
+        return media_files
 
-        elif 'gfycat.com' in self.media_url:  # Gfycat
-            file_paths.append(self.image_helper.get_gfycat_image(self.media_url))
 
-        elif 'giphy.com' in self.media_url:  # Giphy
-            file_paths.append(self.image_helper.get_giphy_image(self.media_url))
+def resolve_reddit_image(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                         url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for images hosted by reddit.
+    """
+    return [helper.get_reddit_image(url)]
+
+
+def resolve_reddit_video(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                         url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for videos hosted by reddit.
+    """
+    if not reddit_post.media:
+        helper.logger.error('Reddit API returned no media for this URL: %s', url)
+        return []
+    return [helper.get_reddit_video(reddit_post)]
 
-        else:
-            file_paths.append(self.image_helper.get_generic_image(self.media_url))
 
-        return file_paths
+def resolve_imgur(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                  url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for Imgur images and galleries.
+    """
+    helper.logger.info('Reddit post %s links to Imgur', reddit_post.id)
+    return list(helper.get_imgur_image(url))
+
+
+def resolve_gfycat(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                   url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for Gfycat pages.
+    """
+    return [helper.get_gfycat_image(url)]
+
+
+def resolve_giphy(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                  url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for Giphy images.
+    """
+    return [helper.get_giphy_image(url)]
+
+
+def resolve_streamable(helper: LinkedMediaHelper, reddit_post: CandidatePost,
+                       url: str) -> List[Optional[MediaFile]]:
+    """
+    Resolver for Streamable pages.
+    """
+    return [helper.get_streamable_video(url)]
@@ -2,37 +2,235 @@
 This module contains helper classes and methods to assist with determining if a reddit post should
 be published on Mastodon / Twitter
 """
+import atexit
 import configparser
 import csv
+import json
 import logging
 import os
+import random
 import sys
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from datetime import datetime
+from datetime import timedelta
 from distutils.util import strtobool
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import urlsplit
 
 import coloredlogs
+import requests
+from requests.adapters import HTTPAdapter
+
+
+CACHE_FILE_HEADER = ['Reddit post ID', 'Date and time', 'Post link', 'Shared URL', 'Media Checksum',
+                     'Perceptual Hash']
+CACHE_DURABILITY_MODES = ('none', 'flush', 'fsync')
+
+
+class BKTree:
+    """
+    BK-tree of integers using the Hamming distance (number of differing bits) between them. This
+    allows finding values close to a given value without comparing it against every value stored.
+    """
+
+    def __init__(self) -> None:
+        # Each node is a list of value and a dict of child nodes keyed by distance to value
+        self.root: Optional[list] = None
+
+    def add(self, value: int) -> None:
+        """
+        Adds value to the tree.
+
+        Arguments:
+            value (int): value to add
+        """
+        if self.root is None:
+            self.root = [value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ value).count('1')
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = [value, {}]
+                return
+            node = node[1][distance]
+
+    def has_close_value(self, value: int, max_distance: int) -> bool:
+        """
+        Checks if the tree holds a value within max_distance of value.
+
+        Arguments:
+            value (int): value to look for
+            max_distance (int): maximum Hamming distance between value and a stored value
+
+        Returns:
+            True if a value within max_distance of value is stored in the tree.
+        """
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = bin(node[0] ^ value).count('1')
+            if distance <= max_distance:
+                return True
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return False
 
 
 class PostRecorder:
     """
     Implements logging of reddit posts published to Mastodon and twitter and also checking against
     the log of published content to determine if a post would be a duplicate.
+
+    The log file is only read once, when the PostRecorder is created. All identifiers found in it
+    are kept in an in memory index that is kept up to date by log_post. This way duplicate checks
+    do not need to read the log file again.
+
+    New log entries are buffered and appended to the log file by a long lived writer either when
+    flush_interval seconds have passed since the last write or when flush is called. The
+    durability setting determines what happens after entries have been written:
+        - 'none': leave it to the operating system when entries reach the disk
+        - 'flush': hand entries over to the operating system straight away
+        - 'fsync': also force entries onto the disk straight away
     """
 
-    def __init__(self, cache_file: str, logger: logging.Logger):
+    def __init__(self, cache_file: str, logger: logging.Logger,
+                 durability: str = 'flush', flush_interval: int = 60):
         self.cache_file = cache_file
         self.logger = logger
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.reddit_ids: Set[str] = set()
+        self.shared_urls: Set[str] = set()
+        self.checksums: Set[str] = set()
+        self.perceptual_hashes = BKTree()
+        self._pending_rows: List[List[str]] = []
+        self._last_flush = time.monotonic()
 
         # Make sure logging file and media directory exists
         if not os.path.exists(self.cache_file):
             with open(self.cache_file, 'w', newline='') as new_cache_file:
-                default = ['Reddit post ID', 'Date and time', 'Post link', 'Media Checksum']
                 csv_writer = csv.writer(new_cache_file)
-                csv_writer.writerow(default)
+                csv_writer.writerow(CACHE_FILE_HEADER)
             logger.info('%s file not found, created a new one', self.cache_file)
             new_cache_file.close()
+        else:
+            self._load_index()
+
+        self._log_file = open(self.cache_file, 'a', newline='')
+        self._csv_writer = csv.writer(self._log_file, delimiter=',')
+        atexit.register(self.close)
+
+    def _load_index(self) -> None:
+        """
+        Reads the existing log file once and adds all identifiers found in it to the in memory
+        index. Log files written with an outdated header are rewritten with the current header.
+        """
+        rows = 0
+        with open(self.cache_file, 'rt', newline='') as cache_file:
+            reader = csv.reader(cache_file, delimiter=',')
+            header = next(reader, None)
+            for row in reader:
+                self._add_to_index(row)
+                rows += 1
+        cache_file.close()
+        self.logger.info('Loaded %s entries from %s', rows, self.cache_file)
+
+        if header != CACHE_FILE_HEADER:
+            self._rewrite_header()
+
+    def compact(self, retention_days: int) -> int:
+        """
+        Removes entries older than retention_days days from the log file and the in memory index.
+        The remaining entries are written to a temporary file first which then atomically replaces
+        the log file. Entries with a date that can not be read are kept.
+
+        Arguments:
+            retention_days (int): number of days entries are kept for
+
+        Returns:
+            removed (int): number of entries removed from the log file
+        """
+        self.close()
+        oldest_to_keep = datetime.now() - timedelta(days=retention_days)
+        self.reddit_ids = set()
+        self.shared_urls = set()
+        self.checksums = set()
+        self.perceptual_hashes = BKTree()
+        removed = 0
+
+        temp_file_name = self.cache_file + '.tmp'
+        with open(self.cache_file, 'rt', newline='') as cache_file, \
+                open(temp_file_name, 'w', newline='') as temp_file:
+            reader = csv.reader(cache_file, delimiter=',')
+            csv_writer = csv.writer(temp_file, delimiter=',')
+            next(reader, None)
+            csv_writer.writerow(CACHE_FILE_HEADER)
+            for row in reader:
+                try:
+                    if datetime.strptime(row[1], '%d/%m/%Y %H:%M:%S') < oldest_to_keep:
+                        removed += 1
+                        continue
+                except (IndexError, ValueError):
+                    pass
+                csv_writer.writerow(row)
+                self._add_to_index(row)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file_name, self.cache_file)
+
+        self._log_file = open(self.cache_file, 'a', newline='')
+        self._csv_writer = csv.writer(self._log_file, delimiter=',')
+        self.logger.info('Removed %s entries older than %s days from %s',
+                         removed, retention_days, self.cache_file)
+        return removed
+
+    def _rewrite_header(self) -> None:
+        """
+        Replaces the first row of the log file with CACHE_FILE_HEADER. The log file is rewritten
+        to a temporary file first which then atomically replaces the log file.
+        """
+        temp_file_name = self.cache_file + '.tmp'
+        with open(self.cache_file, 'rt', newline='') as cache_file, \
+                open(temp_file_name, 'w', newline='') as temp_file:
+            reader = csv.reader(cache_file, delimiter=',')
+            csv_writer = csv.writer(temp_file, delimiter=',')
+            next(reader, None)
+            csv_writer.writerow(CACHE_FILE_HEADER)
+            csv_writer.writerows(reader)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file_name, self.cache_file)
+        self.logger.info('Updated header of %s', self.cache_file)
+
+    def _add_to_index(self, row: List[str]) -> None:
+        """
+        Adds the identifiers of one log row to the in memory index.
+
+        Arguments:
+            row (List[str]): row as written by log_post; reddit id, date, post url, shared url,
+                checksum and perceptual hash
+        """
+        indexed_columns = ((0, self.reddit_ids), (3, self.shared_urls), (4, self.checksums))
+        for column, identifiers in indexed_columns:
+            if len(row) > column and row[column]:
+                identifiers.add(row[column])
+        if len(row) > 5 and row[5]:
+            try:
+                self.perceptual_hashes.add(int(row[5], 16))
+            except ValueError:
+                self.logger.debug('Ignoring invalid perceptual hash: %s', row[5])
 
     def duplicate_check(self, identifier: str) -> bool:
         """
@@ -49,16 +247,47 @@ class PostRecorder:
                 False if "identifier" is not in log of content already posted to Mastodon / Twitter
                 True if "identifier" has been found in log of content.
         """
-        value = False
-        with open(self.cache_file, 'rt', newline='') as cache_file:
-            reader = csv.reader(cache_file, delimiter=',')
-            for row in reader:
-                if identifier in row:
-                    value = True
-        cache_file.close()
-        return value
+        return identifier in self.reddit_ids or \
+            identifier in self.shared_urls or \
+            identifier in self.checksums
+
+    def similar_media_check(self, perceptual_hash: str, max_distance: int) -> bool:
+        """
+        Checks if media that looks like the media with perceptual_hash has already been posted.
+
+        Arguments:
+            perceptual_hash (string): perceptual hash of media attachment as hex string
+            max_distance (int): maximum number of bits perceptual hashes may differ by for media
+                to be considered the same
+
+        Returns:
+            boolean:
+                True if media with a perceptual hash within max_distance has been logged
+        """
+        return self.perceptual_hashes.has_close_value(int(perceptual_hash, 16), max_distance)
 
-    def log_post(self, reddit_id: str, post_url: str, shared_url: str, check_sum: str):
+    def unseen_posts(self, posts: dict) -> dict:
+        """
+        Screens a whole listing of reddit posts against the log in one pass.
+
+        Arguments:
+            posts (dict): posts as returned by RedditHelper.get_reddit_posts, keyed by reddit post
+                id. Each value must have an "id" and "url" attribute.
+
+        Returns:
+            unseen (dict): the entries of posts for which neither the reddit post id nor the
+                shared url have been logged, in the same order as in posts.
+        """
+        unseen = {}
+        for post_id, post in posts.items():
+            if post.id in self.reddit_ids or post.url in self.shared_urls:
+                self.logger.info('Skipping %s because it was already posted', post_id)
+                continue
+            unseen[post_id] = post
+        return unseen
+
+    def log_post(self, reddit_id: str, post_url: str, shared_url: str, check_sum: str,
+                 perceptual_hash: str = ''):
         """
         Logs details about reddit posts that have been published.
 
@@ -72,12 +301,303 @@ class PostRecorder:
             check_sum (string):
                 Checksum of media attachment that was shared on Mastodon / Twitter. This enables
                  checking for duplicate media even if file has been renamed.
+            perceptual_hash (string):
+                Perceptual hash of media attachment that was shared. This enables checking for
+                 duplicate media even if it has been re-encoded or resized.
         """
-        with open(self.cache_file, 'a', newline='') as cache_file:
-            date = time.strftime("%d/%m/%Y") + ' ' + time.strftime("%H:%M:%S")
-            cache_csv_writer = csv.writer(cache_file, delimiter=',')
-            cache_csv_writer.writerow([reddit_id, date, post_url, shared_url, check_sum])
-        cache_file.close()
+        date = time.strftime("%d/%m/%Y") + ' ' + time.strftime("%H:%M:%S")
+        row = [reddit_id, date, post_url, shared_url, check_sum, perceptual_hash]
+        self._pending_rows.append(row)
+        self._add_to_index(row)
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes all buffered log entries to the log file, honouring the durability setting.
+        """
+        if self._pending_rows:
+            self._csv_writer.writerows(self._pending_rows)
+            self._pending_rows = []
+            if self.durability in ('flush', 'fsync'):
+                self._log_file.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._log_file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Writes any buffered log entries and closes the log file.
+        """
+        if not self._log_file.closed:
+            self.flush()
+            self._log_file.close()
+
+
+class ThrottlingScheduler:
+    """
+    Decides how long to wait before the next attempt to post a toot, based on how the Mastodon API
+    responded to earlier attempts.
+    After an error the first retry comes quickly, after that the delay doubles with every further
+    error, with random jitter, up to max_delay. After failure_threshold errors in a row the
+    circuit opens and no toot is attempted for at least the normal delay between posts. The next
+    attempt is then a trial ("half open") that either closes the circuit again or re-opens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, enabled: bool, base_delay: int, max_delay: int,
+                 failure_threshold: int) -> None:
+        self.enabled = enabled
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.retry_after = 0.0
+        self.state = ThrottlingScheduler.CLOSED
+
+    def record_success(self) -> None:
+        """
+        Records that a toot was posted successfully, closing the circuit.
+        """
+        self.failures = 0
+        self.retry_after = 0.0
+        self.state = ThrottlingScheduler.CLOSED
+
+    def record_failure(self, retry_after: float = 0.0) -> None:
+        """
+        Records that the Mastodon API returned an error that may go away by waiting.
+
+        Arguments:
+            retry_after: seconds the server asked to wait before trying again, if known
+        """
+        self.failures += 1
+        self.retry_after = max(0.0, retry_after)
+        if self.state == ThrottlingScheduler.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = ThrottlingScheduler.OPEN
+
+    def next_delay(self, normal_delay: int) -> float:
+        """
+        Returns the number of seconds to wait before the next attempt to post a toot.
+
+        Arguments:
+            normal_delay: delay between posts when no errors occurred
+        """
+        if not self.enabled or self.failures == 0:
+            return normal_delay
+
+        backoff = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+        delay = max(random.uniform(backoff / 2, backoff), self.retry_after)
+        if self.state == ThrottlingScheduler.OPEN:
+            delay = max(delay, normal_delay)
+            self.state = ThrottlingScheduler.HALF_OPEN
+        return min(delay, max(self.max_delay, self.retry_after))
+
+
+class FailureCache:
+    """
+    Remembers urls and hosts that recently failed to download, so they can be skipped without
+    waiting for another timeout.
+    A failed url is skipped for url_ttl seconds. A host is skipped for host_ttl seconds once
+    host_failure_threshold downloads from it have failed in a row. After that a single download
+    from the host is let through as a trial, which either clears the host again or makes it be
+    skipped for another host_ttl seconds.
+    """
+
+    def __init__(self, url_ttl: int, host_ttl: int, host_failure_threshold: int) -> None:
+        self.url_ttl = url_ttl
+        self.host_ttl = host_ttl
+        self.host_failure_threshold = host_failure_threshold
+        self.failed_urls: Dict[str, float] = {}
+        self.host_failures: Dict[str, int] = {}
+        self.host_blocked_until: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def is_blocked(self, url: str, host: Optional[str] = None) -> bool:
+        """
+        Checks if url, or the host it points to, has failed recently.
+
+        Arguments:
+            url: url about to be downloaded
+            host: [optional] host the url is fetched through, if not the host in url
+
+        Returns:
+            True if the download should be skipped
+        """
+        now = time.monotonic()
+        host = host or urlsplit(url).hostname or ''
+        with self.lock:
+            if self.failed_urls.get(url, 0.0) > now:
+                return True
+            self.failed_urls.pop(url, None)
+
+            blocked_until = self.host_blocked_until.get(host)
+            if blocked_until is None:
+                return False
+            if blocked_until > now:
+                return True
+            # Let one trial request through until it has either failed or succeeded
+            self.host_blocked_until[host] = now + self.host_ttl
+            return False
+
+    def peek(self, url: str, host: Optional[str] = None) -> bool:
+        """
+        Checks if url, or the host it points to, is being skipped, without handing out the trial
+        request for a host. Use this to screen links that are not about to be downloaded.
+
+        Arguments:
+            url: url to check
+            host: [optional] host the url is fetched through, if not the host in url
+
+        Returns:
+            True if a download of url would currently be skipped
+        """
+        now = time.monotonic()
+        host = host or urlsplit(url).hostname or ''
+        with self.lock:
+            return self.failed_urls.get(url, 0.0) > now or \
+                self.host_blocked_until.get(host, 0.0) > now
+
+    def record_failure(self, url: str, host_failed: bool = False,
+                       host: Optional[str] = None) -> None:
+        """
+        Records that url failed to download.
+
+        Arguments:
+            url: url that failed
+            host_failed: True if the host itself could not be reached or returned a server error
+            host: [optional] host the url is fetched through, if not the host in url
+        """
+        now = time.monotonic()
+        host = host or urlsplit(url).hostname or ''
+        with self.lock:
+            self.failed_urls[url] = now + self.url_ttl
+            if not host_failed:
+                return
+            self.host_failures[host] = self.host_failures.get(host, 0) + 1
+            if self.host_failures[host] >= self.host_failure_threshold:
+                self.host_blocked_until[host] = now + self.host_ttl
+
+    def record_success(self, url: str, host: Optional[str] = None) -> None:
+        """
+        Records that a download from url worked, clearing any failures of its host.
+
+        Arguments:
+            url: url that was downloaded
+            host: [optional] host the url is fetched through, if not the host in url
+        """
+        host = host or urlsplit(url).hostname or ''
+        with self.lock:
+            self.host_failures.pop(host, None)
+            self.host_blocked_until.pop(host, None)
+
+
+class HttpCache:
+    """
+    On-disk cache of values looked up from web pages and APIs, such as the media url found on a
+    page. The ETag and Last-Modified headers of the page are kept with the value so the page can be
+    requested again conditionally once the value is older than ttl seconds. Only the max_entries
+    most recently used values are kept.
+    """
+
+    def __init__(self, cache_file: str, ttl: int, max_entries: int,
+                 logger: logging.Logger) -> None:
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.logger = logger
+        self.entries: 'OrderedDict[str, dict]' = OrderedDict()
+        self.changed = False
+        self.lock = threading.Lock()
+        if max_entries > 0 and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as json_file:
+                    self.entries = OrderedDict(json.load(json_file))
+            except (OSError, ValueError) as load_error:
+                logger.warning('Ignoring http cache %s: %s', cache_file, load_error)
+        atexit.register(self.save)
+
+    def lookup(self, url: str) -> Tuple[Optional[dict], bool]:
+        """
+        Looks up the cached value for url.
+
+        Arguments:
+            url: url of the page or API call
+
+        Returns:
+            entry: cached entry with the value and the validators of the page, or None
+            fresh: True if the value is younger than ttl and can be used without asking the site
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None, False
+            self.entries.move_to_end(url)
+            return entry, time.time() - entry['stored_at'] < self.ttl
+
+    @staticmethod
+    def conditional_headers(entry: Optional[dict]) -> dict:
+        """
+        Returns the headers that make a request for a page conditional on it having changed since
+        entry was stored.
+        """
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url: str, value, response_headers: Optional[dict] = None) -> None:
+        """
+        Stores value, which must be JSON serializable, for url.
+
+        Arguments:
+            url: url of the page or API call
+            value: value looked up from the page
+            response_headers: [optional] headers returned with the page
+        """
+        if self.max_entries <= 0:
+            return
+        response_headers = response_headers or {}
+        with self.lock:
+            self.entries[url] = {'value': value,
+                                 'etag': response_headers.get('ETag'),
+                                 'last_modified': response_headers.get('Last-Modified'),
+                                 'stored_at': time.time()}
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.changed = True
+
+    def refresh(self, url: str) -> None:
+        """
+        Marks the value for url as fresh again after the site confirmed the page has not changed.
+        """
+        with self.lock:
+            if url in self.entries:
+                self.entries[url]['stored_at'] = time.time()
+                self.changed = True
+
+    def save(self) -> None:
+        """
+        Writes the cache to disk if it has changed. The cache is written to a temporary file first
+        which then atomically replaces the cache file.
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            temp_file_name = self.cache_file + '.tmp'
+            try:
+                with open(temp_file_name, 'w', encoding='utf-8') as temp_file:
+                    json.dump(self.entries, temp_file)
+                os.replace(temp_file_name, self.cache_file)
+                self.changed = False
+            except OSError as save_error:
+                self.logger.error('Error while saving http cache: %s', save_error)
 
 
 @dataclass
@@ -87,6 +607,15 @@ class BotConfig:
     """
     cache_file: str
     post_recorder: PostRecorder
+    cache_retention_days: int
+    cache_compaction_interval: int
+    prefetch_enabled: bool
+    prefetch_lead_time: int
+    prefetch_max_age: int
+    posts_per_cycle: int
+    min_post_interval: int
+    fair_post_spread: bool
+    rank_posts: bool
     delay_between_posts: int
     run_once_only: bool
     hash_tags: List
@@ -105,6 +634,7 @@ class RedditReaderConfig:
     spoilers: bool
     self_posts: bool
     stickied_allowed: bool
+    fetch_workers: int
 
 
 @dataclass
@@ -126,6 +656,20 @@ class HealthCheckConfig:
     uuid: str
 
 
+@dataclass
+class ImageTransformConfig:
+    """
+    Dataclass holding configuration values around scaling down and re-encoding images before
+    they are posted
+    """
+    enabled: bool
+    max_dimension: int
+    png_max_size: int
+    image_format: str
+    quality: int
+    workers: int
+
+
 @dataclass
 class MediaConfig:
     """
@@ -133,21 +677,40 @@ class MediaConfig:
     """
     folder: str
     media_only: bool
+    download_workers: int
+    downloads_per_host: int
+    max_download_size: int
+    image_transform: ImageTransformConfig
+    perceptual_hash_distance: int
+
+
+@dataclass
+class HttpConfig:
+    """
+    Dataclass holding configuration values for downloads and other http requests. This also holds
+    the requests session shared by all http requests so connections to a host can be re-used, the
+    cache of urls and hosts that recently failed and the cache of values looked up from web pages.
+    """
+    session: requests.Session
+    chunk_size: int
+    timeout: Tuple[float, float]
+    failures: FailureCache
+    cache: HttpCache
 
 
 @dataclass
 class MastodonConfig:
     """
     Dataclass holding configuration values for Mastodon settings.
-    This also stores the number of times the mastodon API has returned an error to allow throttling
-    of posting toots in a controlled manner
+    This also holds the scheduler keeping track of errors returned by the mastodon API to allow
+    throttling of posting toots in a controlled manner
     """
     domain: str
     media_always_sensitive: bool
     delete_after: int
-    throttling_enabled: bool
-    throttling_max_delay: int
-    number_of_errors: int
+    scheduler: ThrottlingScheduler
+    media_processing_timeout: int
+    deletion_rate_reserve: int
 
 
 @dataclass
@@ -169,6 +732,7 @@ class Configuration:
     promo: PromoConfig
     health: HealthCheckConfig
     media: MediaConfig
+    http: HttpConfig
     mastodon_config: MastodonConfig
     reddit: RedditReaderConfig
 
@@ -198,8 +762,31 @@ class Configuration:
             # Parse list of hashtags
             hash_tags_string = config['BotSettings']['Hashtags']
             hash_tags = [x.strip() for x in hash_tags_string.split(',')]
+        cache_durability = bot_settings.get('CacheDurability', 'flush').lower()
+        if cache_durability not in CACHE_DURABILITY_MODES:
+            logger.error('CacheDurability must be one of %s', ', '.join(CACHE_DURABILITY_MODES))
+            sys.exit(1)
+        post_recorder = PostRecorder(bot_settings['CacheFile'], logger,
+                                     durability=cache_durability,
+                                     flush_interval=bot_settings.getint('CacheFlushInterval',
+                                                                        fallback=60))
         self.bot = BotConfig(cache_file=bot_settings['CacheFile'],
-                             post_recorder=PostRecorder(bot_settings['CacheFile'], logger),
+                             post_recorder=post_recorder,
+                             cache_retention_days=bot_settings.getint('CacheRetentionDays',
+                                                                      fallback=0),
+                             cache_compaction_interval=bot_settings.getint(
+                                 'CacheCompactionInterval', fallback=24),
+                             prefetch_enabled=bot_settings.getboolean('PrefetchEnabled',
+                                                                      fallback=False),
+                             prefetch_lead_time=bot_settings.getint('PrefetchLeadTime',
+                                                                    fallback=120),
+                             prefetch_max_age=bot_settings.getint('PrefetchMaxAge', fallback=600),
+                             posts_per_cycle=max(1, bot_settings.getint('PostsPerCycle',
+                                                                        fallback=1)),
+                             min_post_interval=bot_settings.getint('MinPostInterval', fallback=30),
+                             fair_post_spread=bot_settings.getboolean('FairPostSpread',
+                                                                      fallback=False),
+                             rank_posts=bot_settings.getboolean('RankPosts', fallback=False),
                              delay_between_posts=int(bot_settings['DelayBetweenPosts']),
                              run_once_only=strtobool(bot_settings['RunOnceOnly']),
                              hash_tags=hash_tags,
@@ -214,6 +801,7 @@ class Configuration:
             spoilers=strtobool(bot_settings['SpoilersAllowed']),
             self_posts=strtobool(bot_settings['SelfPostsAllowed']),
             stickied_allowed=strtobool(bot_settings['StickiedPostsAllowed']),
+            fetch_workers=bot_settings.getint('RedditFetchWorkers', fallback=4),
         )
 
         # Settings related to promotional messages
@@ -233,7 +821,57 @@ class Configuration:
         # Settings related to media attachments
         media_settings = config['MediaSettings']
         self.media = MediaConfig(folder=media_settings['MediaFolder'],
-                                 media_only=strtobool(media_settings['MediaPostsOnly']))
+                                 media_only=strtobool(media_settings['MediaPostsOnly']),
+                                 download_workers=media_settings.getint('DownloadWorkers',
+                                                                        fallback=4),
+                                 downloads_per_host=media_settings.getint('DownloadsPerHost',
+                                                                          fallback=2),
+                                 max_download_size=media_settings.getint('MaxDownloadSize',
+                                                                         fallback=100) * 1048576,
+                                 image_transform=ImageTransformConfig(
+                                     enabled=media_settings.getboolean('TransformImages',
+                                                                       fallback=False),
+                                     max_dimension=media_settings.getint('ImageMaxDimension',
+                                                                         fallback=2048),
+                                     png_max_size=media_settings.getint('ImagePngMaxSize',
+                                                                        fallback=1024) * 1024,
+                                     image_format=media_settings.get('ImageFormat',
+                                                                     'JPEG').upper(),
+                                     quality=media_settings.getint('ImageQuality', fallback=85),
+                                     workers=media_settings.getint('ImageWorkers', fallback=2)),
+                                 perceptual_hash_distance=media_settings.getint(
+                                     'PerceptualHashDistance', fallback=0))
+        if self.media.image_transform.image_format not in ('JPEG', 'WEBP'):
+            logger.error('ImageFormat must be one of JPEG, WEBP')
+            sys.exit(1)
+
+        # Settings related to http requests
+        connections_per_host = config.getint('HttpSettings', 'ConnectionsPerHost', fallback=4)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=connections_per_host)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.http = HttpConfig(session=session,
+                               chunk_size=config.getint('HttpSettings', 'ChunkSize',
+                                                        fallback=65536),
+                               timeout=(config.getfloat('HttpSettings', 'ConnectTimeout',
+                                                        fallback=5),
+                                        config.getfloat('HttpSettings', 'ReadTimeout',
+                                                        fallback=30)),
+                               failures=FailureCache(
+                                   url_ttl=config.getint('HttpSettings', 'FailedUrlTtl',
+                                                         fallback=3600),
+                                   host_ttl=config.getint('HttpSettings', 'FailedHostTtl',
+                                                          fallback=600),
+                                   host_failure_threshold=config.getint(
+                                       'HttpSettings', 'HostFailureThreshold', fallback=3)),
+                               cache=HttpCache(
+                                   cache_file=config.get('HttpSettings', 'CacheFile',
+                                                         fallback='http_cache.json'),
+                                   ttl=config.getint('HttpSettings', 'CacheTtl', fallback=86400),
+                                   max_entries=config.getint('HttpSettings', 'CacheMaxEntries',
+                                                             fallback=1000),
+                                   logger=logger))
 
         # Mastodon info
         mastodon_settings = config['Mastodon']
@@ -242,11 +880,19 @@ class Configuration:
                                                   mastodon_settings['SensitiveMedia']),
                                               delete_after=int(
                                                   mastodon_settings['DeleteAfterDays']),
-                                              throttling_enabled=strtobool(
-                                                  mastodon_settings['ThrottlingEnabled']),
-                                              throttling_max_delay=int(
-                                                  mastodon_settings['ThrottlingMaxDelay']),
-                                              number_of_errors=0)
+                                              scheduler=ThrottlingScheduler(
+                                                  enabled=strtobool(
+                                                      mastodon_settings['ThrottlingEnabled']),
+                                                  base_delay=mastodon_settings.getint(
+                                                      'ThrottlingBaseDelay', fallback=30),
+                                                  max_delay=int(
+                                                      mastodon_settings['ThrottlingMaxDelay']),
+                                                  failure_threshold=mastodon_settings.getint(
+                                                      'ThrottlingFailureThreshold', fallback=5)),
+                                              media_processing_timeout=mastodon_settings.getint(
+                                                  'MediaProcessingTimeout', fallback=300),
+                                              deletion_rate_reserve=mastodon_settings.getint(
+                                                  'DeletionRateReserve', fallback=50))
 
         self.subreddits = []
         for subreddit, hashtags in config.items('Subreddits'):
@@ -3,35 +3,77 @@ This module is a collection of classes and methods to perform the actual posting
  Mastodon / Twitter
 """
 
+import heapq
+import itertools
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 import arrow
 from mastodon import Mastodon
+from mastodon import MastodonAPIError
 from mastodon import MastodonError
+from mastodon import MastodonRatelimitError
+from mastodon import MastodonServerError
 
+from collect import CandidatePost
 from collect import LinkedMediaHelper
 from collect import MediaAttachment
+from collect import MediaLimits
 from collect import RedditHelper
 from control import Configuration
 
 
+@dataclass
+class StagedPost:
+    """
+    Dataclass holding a post prepared ahead of time together with the reddit posts it was picked
+    from
+    """
+    posts: dict
+    post: CandidatePost
+    attachments: MediaAttachment
+    staged_at: float
+
+    def is_stale(self, max_age: int) -> bool:
+        """
+        Checks if the post was prepared more than max_age seconds ago.
+        """
+        return time.monotonic() - self.staged_at > max_age
+
+
 class MastodonPublisher:
     """
     Ease the publishing of content to Mastodon
     """
 
     MAX_LEN_TOOT = 500
+    # Candidates skipped in one cycle, because their media could not be used, before control
+    # returns to the main loop
+    MAX_SKIPS_PER_CYCLE = 10
 
     def __init__(self, config: Configuration, secrets_file: str = 'mastodon.secret') -> None:
         self.logger = config.bot.logger
         self.media_only = config.media.media_only
+        self.perceptual_hash_distance = config.media.perceptual_hash_distance
         self.nsfw_marked = config.reddit.nsfw_marked
         self.mastodon_config = config.mastodon_config
         self.post_recorder = config.bot.post_recorder
         self.num_non_promo_posts = 0
         self.promo = config.promo
+        self.posts_per_cycle = config.bot.posts_per_cycle
+        self.min_post_interval = config.bot.min_post_interval
+        self.fair_post_spread = config.bot.fair_post_spread
+        self.rank_posts = config.bot.rank_posts
+        self.failures = config.http.failures
+        self.upload_pool = ThreadPoolExecutor(max_workers=4)
 
         api_base_url = 'https://' + self.mastodon_config.domain
 
@@ -49,7 +91,8 @@ class MastodonPublisher:
                                     api_base_url=api_base_url,
                                     to_file=secrets_file)
                 self.mastodon = Mastodon(client_id=secrets_file,
-                                         api_base_url='https://' + self.mastodon_config.domain)
+                                         api_base_url='https://' + self.mastodon_config.domain,
+                                         ratelimit_method='throw')
                 self.mastodon.log_in(user_name, password, to_file=secrets_file)
                 # Make sure authentication is working
                 self.userinfo = self.mastodon.account_verify_credentials()
@@ -64,7 +107,10 @@ class MastodonPublisher:
                 sys.exit(1)
         else:
             try:
-                self.mastodon = Mastodon(access_token=secrets_file, api_base_url=api_base_url)
+                # Rate limit errors are raised rather than waited out inside the call, so the
+                # throttling scheduler decides when to try again
+                self.mastodon = Mastodon(access_token=secrets_file, api_base_url=api_base_url,
+                                         ratelimit_method='throw')
                 # Make sure authentication is working
                 self.userinfo = self.mastodon.account_verify_credentials()
                 mastodon_username = self.userinfo['username']
@@ -76,125 +122,322 @@ class MastodonPublisher:
                 config.bot.logger.error('Tootbot cannot continue, now shutting down')
                 sys.exit(1)
 
+        self.media_limits = self._get_media_limits()
+
+    def _get_media_limits(self) -> Optional[MediaLimits]:
+        """
+        _get_media_limits reads the limits for media attachments from the configuration returned
+        by the instance API.
+
+        Returns:
+            media_limits (MediaLimits): limits for media attachments, or None if the instance did
+            not return them
+        """
+        try:
+            instance = self.mastodon.instance()
+        except MastodonError as mastodon_error:
+            self.logger.warning('Could not read media limits of instance: %s', mastodon_error)
+            return None
+
+        media_configuration = (instance.get('configuration') or {}).get('media_attachments')
+        if not media_configuration:
+            self.logger.info('Instance did not return any limits for media attachments')
+            return None
+
+        media_limits = MediaLimits(
+            supported_types=tuple(media_configuration.get('supported_mime_types') or ()),
+            image_size_limit=media_configuration.get('image_size_limit') or 0,
+            video_size_limit=media_configuration.get('video_size_limit') or 0)
+        self.logger.debug('Media limits of instance: %s', media_limits)
+        return media_limits
+
     def make_post(self, posts: dict, reddit_helper: RedditHelper,
-                  media_helper: LinkedMediaHelper) -> None:
+                  media_helper: LinkedMediaHelper,
+                  staged_post: Optional[StagedPost] = None) -> None:
         """
-        Makes a post on mastodon from a selection of reddit submissions.
+        Makes up to posts_per_cycle posts on mastodon from a selection of reddit submissions,
+        waiting at least min_post_interval seconds between toots. Candidates that are skipped
+        do not count towards posts_per_cycle, up to MAX_SKIPS_PER_CYCLE of them.
 
         Arguments:
-            posts: A dictionary of subreddit specific hash tags and PRAW Submission objects
+            posts: A dictionary of subreddit specific hash tags and CandidatePost objects
             reddit_helper: Helper class to work with Reddit
-            media_helper: Helper class to retrieve media linked to from a reddit Submission.
+            media_helper: Helper class to retrieve media linked to from a reddit post.
+            staged_post: [optional] post prepared earlier by stage_post. Its media are used if
+                the post is picked again, otherwise they are removed.
         """
-        break_to_mainloop = False
-        for additional_hashtags, source_posts in posts.items():
-            if break_to_mainloop:
+        handled = 0
+        skipped = 0
+        last_toot_at = None
+        for additional_hashtags, post in self._candidates(posts):
+            # Grab post details
+            post_id = post.id
+            shared_url = post.url
+
+            # Hashtag groups can share posts, and a post may have been handled already in this
+            # cycle since its group was screened
+            if self.post_recorder.duplicate_check(post_id) or \
+                    self.post_recorder.duplicate_check(shared_url):
+                self.logger.info('Skipping %s because it was already posted', post_id)
+                continue
+            self.logger.debug('Processing reddit post: %s', post)
+
+            if staged_post is not None and staged_post.post.id == post_id:
+                self.logger.info('Using media prepared earlier for %s', post_id)
+                attachments = staged_post.attachments
+                staged_post = None
+            else:
+                attachments = MediaAttachment(post,
+                                              media_helper,
+                                              self.logger
+                                              )
+            number_attachments = len(attachments.media_paths)
+
+            self._remove_posted_earlier(attachments)
+
+            if number_attachments > 0 and len(attachments.media_paths) == 0:
+                self.logger.info(
+                    'Skipping %s because all attachments have already been posted', post_id)
+                self.post_recorder.log_post(
+                    post_id,
+                    'Mastodon: Skipped because all images have already been posted',
+                    '',
+                    '')
+                skipped += 1
+                if skipped >= MastodonPublisher.MAX_SKIPS_PER_CYCLE:
+                    break
+                continue
+
+            self.logger.debug('Media posts only: %s', self.media_only)
+            # Make sure the post contains media,
+            # if MEDIA_POSTS_ONLY in config is set to True
+            if (self.media_only and len(attachments.media_paths) > 0) or \
+                    (not self.media_only):
+
+                self.logger.debug('Going to post Toot.')
+                if last_toot_at is not None:
+                    time.sleep(max(0.0, self.min_post_interval -
+                                   (time.monotonic() - last_toot_at)))
+
+                try:
+                    promo_message = None
+                    if self.num_non_promo_posts >= self.promo.every > 0:
+                        promo_message = self.promo.message
+                        self.num_non_promo_posts = -1
+
+                    # Generate post caption
+                    caption = reddit_helper.get_caption(post,
+                                                        MastodonPublisher.MAX_LEN_TOOT,
+                                                        add_hash_tags=additional_hashtags,
+                                                        promo_message=promo_message)
+
+                    # Upload media files if available
+                    media_ids = None
+                    if len(attachments.media_paths) > 0:
+                        self.logger.info('Posting to Mastodon with media(s): %s', caption)
+                        media_ids = self._post_attachments(attachments, post_id)
+                    else:
+                        self.logger.info('Posting to Mastodon without media: %s', caption)
+
+                    spoiler = None
+                    if post.over_18 and self.nsfw_marked:
+                        spoiler = 'NSFW'
+
+                    toot = self.mastodon.status_post(
+                        status=caption,
+                        media_ids=media_ids,
+                        sensitive=self.mastodon_config.media_always_sensitive,
+                        spoiler_text=spoiler)
+
+                    # Log the toot, and write it out straight away so it is not posted again if
+                    # tootbot is stopped before the log is next written
+                    self.post_recorder.log_post(post_id, toot["url"], shared_url, '')
+                    self.post_recorder.flush()
+
+                    self.num_non_promo_posts += 1
+                    self.mastodon_config.scheduler.record_success()
+                    last_toot_at = time.monotonic()
+
+                except MastodonError as mastodon_error:
+                    self.logger.error('Error while posting toot: %s', mastodon_error)
+                    # Log the post anyways so we don't get into a loop of the same error
+                    self.post_recorder.log_post(
+                        post_id,
+                        'Error while posting toot: %s' % mastodon_error,
+                        '',
+                        '')
+                    self._record_error(mastodon_error)
+                    # Leave it to the throttling scheduler when to try again
+                    handled = self.posts_per_cycle
+                handled += 1
+
+            else:
+                self.logger.warning(
+                    'Skipping %s, non-media posts disabled or media file not found',
+                    post_id)
+                # Log the post anyways
+                self.post_recorder.log_post(
+                    post_id,
+                    'Skipping, non-media posts disabled or media file not found',
+                    '',
+                    ''
+                )
+                skipped += 1
+            # Clean up media file
+            attachments.destroy()
+            if handled >= self.posts_per_cycle or \
+                    skipped >= MastodonPublisher.MAX_SKIPS_PER_CYCLE:
+                # Return control to main loop
                 break
 
-            for post in source_posts:
-                # Grab post details from dictionary
-                post_id = source_posts[post].id
-                shared_url = source_posts[post].url
-                if not (self.post_recorder.duplicate_check(post_id) or
-                        self.post_recorder.duplicate_check(shared_url)):
-                    self.logger.debug('Processing reddit post: %s', source_posts[post])
-
-                    attachments = MediaAttachment(source_posts[post],
-                                                  media_helper,
-                                                  self.logger
-                                                  )
-                    number_attachments = len(attachments.media_paths)
-
-                    self._remove_posted_earlier(attachments)
-
-                    if number_attachments > 0 and len(attachments.media_paths) == 0:
-                        self.logger.info(
-                            'Skipping %s because all attachments have already been posted', post_id)
-                        self.post_recorder.log_post(
-                            post_id,
-                            'Mastodon: Skipped because all images have already been posted',
-                            '',
-                            '')
-                        continue
-
-                    self.logger.debug('Media posts only: %s', self.media_only)
-                    # Make sure the post contains media,
-                    # if MEDIA_POSTS_ONLY in config is set to True
-                    if (self.media_only and len(attachments.media_paths) > 0) or \
-                            (not self.media_only):
-
-                        self.logger.debug('Going to post Toot.')
-
-                        try:
-                            promo_message = None
-                            if self.num_non_promo_posts >= self.promo.every > 0:
-                                promo_message = self.promo.message
-                                self.num_non_promo_posts = -1
-
-                            # Generate post caption
-                            caption = reddit_helper.get_caption(source_posts[post],
-                                                                MastodonPublisher.MAX_LEN_TOOT,
-                                                                add_hash_tags=additional_hashtags,
-                                                                promo_message=promo_message)
-
-                            # Upload media files if available
-                            media_ids = None
-                            if len(attachments.media_paths) > 0:
-                                self.logger.info('Posting to Mastodon with media(s): %s', caption)
-                                media_ids = self._post_attachments(attachments, post_id)
-                            else:
-                                self.logger.info('Posting to Mastodon without media: %s', caption)
-
-                            spoiler = None
-                            if source_posts[post].over_18 and self.nsfw_marked:
-                                spoiler = 'NSFW'
-
-                            toot = self.mastodon.status_post(
-                                status=caption,
-                                media_ids=media_ids,
-                                sensitive=self.mastodon_config.media_always_sensitive,
-                                spoiler_text=spoiler)
-
-                            # Log the toot
-                            self.post_recorder.log_post(post_id, toot["url"], shared_url, '')
-
-                            self.num_non_promo_posts += 1
-                            self.mastodon_config.number_of_errors = 0
-
-                        except MastodonError as mastodon_error:
-                            self.logger.error('Error while posting toot: %s', mastodon_error)
-                            # Log the post anyways so we don't get into a loop of the same error
-                            self.post_recorder.log_post(
-                                post_id,
-                                'Error while posting toot: %s' % mastodon_error,
-                                '',
-                                '')
-                            self.mastodon_config.number_of_errors += 1
+        if staged_post is not None:
+            self.logger.info('Discarding media prepared for %s', staged_post.post.id)
+            staged_post.attachments.destroy()
 
-                    else:
-                        self.logger.warning(
-                            'Skipping %s, non-media posts disabled or media file not found',
-                            post_id)
-                        # Log the post anyways
-                        self.post_recorder.log_post(
-                            post_id,
-                            'Skipping, non-media posts disabled or media file not found',
-                            '',
-                            ''
-                        )
-
-                    # Clean up media file
-                    attachments.destroy()
-
-                    # Return control to main loop
-                    break_to_mainloop = True
-                    break
+    def _record_error(self, mastodon_error: MastodonError) -> None:
+        """
+        Passes errors that may go away by waiting on to the throttling scheduler. Errors about the
+        toot itself, like a rejected caption, do not slow down posting.
 
-                self.logger.info('Skipping %s because it was already posted', post_id)
+        Arguments:
+            mastodon_error: error raised while posting a toot
+        """
+        if isinstance(mastodon_error, MastodonRatelimitError):
+            retry_after = self.mastodon.ratelimit_reset - time.time()
+            self.mastodon_config.scheduler.record_failure(retry_after=retry_after)
+        elif isinstance(mastodon_error, MastodonAPIError) and \
+                not isinstance(mastodon_error, MastodonServerError):
+            self.logger.debug('Not throttling for client error %s', mastodon_error)
+        else:
+            self.mastodon_config.scheduler.record_failure()
+
+    def stage_post(self, posts: dict, media_helper: LinkedMediaHelper) -> Optional[StagedPost]:
+        """
+        Prepares the post make_post is going to pick next by downloading its media ahead of time.
+
+        Arguments:
+            posts: A dictionary of subreddit specific hash tags and CandidatePost objects
+            media_helper: Helper class to retrieve media linked to from a reddit post.
+
+        Returns:
+            staged_post: the prepared post together with posts, or None if there is nothing to post
+        """
+        for _, post in self._candidates(posts):
+            self.logger.info('Preparing reddit post %s', post.id)
+            return StagedPost(posts=posts,
+                              post=post,
+                              attachments=MediaAttachment(post, media_helper, self.logger),
+                              staged_at=time.monotonic())
+        return None
+
+    def _candidates(self, posts: dict) -> Iterator[Tuple[str, CandidatePost]]:
+        """
+        _candidates returns reddit posts that have not been posted yet, in the order they should
+        be considered for posting. With rank_posts the best posts of all hashtag groups come
+        first, with fair_post_spread the hashtag groups take turns.
+
+        Arguments:
+            posts: A dictionary of subreddit specific hash tags and CandidatePost objects
+
+        Returns:
+            candidates: iterator of tuples of subreddit specific hash tags and CandidatePost
+        """
+        now = time.time()
+        groups = [self._group_candidates(additional_hashtags, source_posts, now)
+                  for additional_hashtags, source_posts in posts.items()]
+
+        if self.fair_post_spread:
+            candidates = self._take_turns(groups)
+        elif self.rank_posts:
+            # heapq.merge screens every group against the log before the first post is returned
+            candidates = heapq.merge(*groups, key=lambda candidate: candidate[0])
+        else:
+            candidates = itertools.chain(*groups)
+
+        # Hashtag groups can list the same post, only offer it once
+        offered = set()
+        for _, additional_hashtags, post in candidates:
+            if post.id in offered:
+                continue
+            offered.add(post.id)
+            yield additional_hashtags, post
+
+    @staticmethod
+    def _take_turns(groups: List[Iterator[Tuple[float, str, CandidatePost]]]
+                    ) -> Iterator[Tuple[float, str, CandidatePost]]:
+        """
+        _take_turns returns one candidate from each hashtag group in turn.
+        """
+        while groups:
+            for group in list(groups):
+                candidate = next(group, None)
+                if candidate is None:
+                    groups.remove(group)
+                else:
+                    yield candidate
+
+    def _group_candidates(self, additional_hashtags: str, source_posts: dict,
+                          now: float) -> Iterator[Tuple[float, str, CandidatePost]]:
+        """
+        _group_candidates returns the posts of one hashtag group that have not been posted yet.
+        Posts that cannot be posted without media are logged as skipped and left out, as are posts
+        linking to media that failed to download recently. With rank_posts the posts are returned
+        best first.
+
+        Arguments:
+            additional_hashtags: subreddit specific hash tags of the group
+            source_posts: dictionary of reddit ids and CandidatePost objects of the group
+            now: current time as a unix timestamp
+
+        Returns:
+            candidates: iterator of tuples of sort key, hash tags and CandidatePost
+        """
+        heap = []
+        for post in self.post_recorder.unseen_posts(source_posts).values():
+            if self.media_only and post.has_no_media():
+                self.logger.info('Skipping %s, it has no media to post', post.id)
+                self.post_recorder.log_post(post.id, 'Skipping, post has no media', '', '')
+                continue
+            if self.media_only and self.failures.peek(post.url):
+                # Not logged as posted, so the post is tried again once the site is back
+                self.logger.info('Skipping %s for now, its media failed to download recently',
+                                 post.id)
+                continue
+            if not self.rank_posts:
+                yield 0.0, additional_hashtags, post
+                continue
+            heap.append((-self._priority(post, now), len(heap), post))
+
+        heapq.heapify(heap)
+        while heap:
+            sort_key, _, post = heapq.heappop(heap)
+            yield sort_key, additional_hashtags, post
+
+    @staticmethod
+    def _priority(post: CandidatePost, now: float) -> float:
+        """
+        Works out how worthwhile posting a reddit post is from how fast it has been upvoted. Older
+        posts need ever more upvotes to keep up with newer ones, and posts that link to media
+        tootbot knows how to download count double.
+
+        Arguments:
+            post: reddit post to work out priority for
+            now: current time as a unix timestamp
+
+        Returns:
+            priority: higher is better
+        """
+        age_hours = max(0.0, now - post.created_utc) / 3600
+        priority = (max(post.score, 0) + 1) / (age_hours + 2) ** 1.5
+        if post.has_known_media():
+            priority *= 2
+        return priority
 
     def _post_attachments(self, attachments: MediaAttachment, post_id: str) -> List[dict]:
         """
-        _post_attachments post any media in attachments.media_paths list
+        _post_attachments post any media in attachments.media_paths list. All media are uploaded
+        at the same time. This method then waits until Mastodon has finished processing all of
+        them, so the media can be attached to a toot straight away.
 
         Arguments:
             attachments: object with a list of paths to media to be posted on Mastodon
@@ -202,17 +445,49 @@ class MastodonPublisher:
         Returns:
             media_ids: List of dicts returned by mastodon.media_post
         """
-        media_ids = []
+        uploads = []
         for checksum, media_path in attachments.media_paths.items():
             self.logger.info('Media %s with checksum: %s',
                              media_path,
                              checksum)
-            media = self.mastodon.media_post(media_path)
+            uploads.append(self.upload_pool.submit(self.mastodon.media_post, media_path))
+
+        media_ids = []
+        for upload, (checksum, media_path) in zip(uploads, attachments.media_paths.items()):
+            media = upload.result()
             # Log the media upload
             self.post_recorder.log_post(post_id,
                                         '',
-                                        media_path, checksum)
+                                        media_path, checksum,
+                                        attachments.perceptual_hashes.get(checksum, ''))
             media_ids.append(media)
+        return self._wait_for_processing(media_ids)
+
+    def _wait_for_processing(self, media_ids: List[dict]) -> List[dict]:
+        """
+        _wait_for_processing polls Mastodon until all media uploaded with the asynchronous media
+        API have been processed.
+
+        Arguments:
+            media_ids: List of dicts returned by mastodon.media_post
+
+        Returns:
+            media_ids: List of dicts for the processed media, in the same order as before
+
+        Raises:
+            MastodonError: if media have not been processed within media_processing_timeout
+        """
+        deadline = time.monotonic() + self.mastodon_config.media_processing_timeout
+        poll_interval = 1.0
+        while any(media.get('url') is None for media in media_ids):
+            if time.monotonic() > deadline:
+                raise MastodonError('Mastodon did not finish processing media within %s seconds'
+                                    % self.mastodon_config.media_processing_timeout)
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, 5.0)
+            media_ids = [self.mastodon.media(media) if media.get('url') is None else media
+                         for media in media_ids]
+            self.logger.debug('Waiting for Mastodon to process media')
         return media_ids
 
     def _remove_posted_earlier(self, attachments: MediaAttachment) -> None:
@@ -235,40 +510,139 @@ class MastodonPublisher:
                 self.logger.info('Media with checksum %s has already been posted',
                                  checksum)
                 checksums.append(checksum)
+            # Check for media that looks like media posted earlier
+            elif self.perceptual_hash_distance > 0 and checksum in attachments.perceptual_hashes \
+                    and self.post_recorder.similar_media_check(
+                        attachments.perceptual_hashes[checksum], self.perceptual_hash_distance):
+                self.logger.info('Media similar to %s has already been posted',
+                                 attachments.media_paths[checksum])
+                checksums.append(checksum)
         # Remove all empty or previously posted images
         for checksum in checksums:
             attachments.destroy_one_attachment(checksum)
 
-    def delete_toots(self, older_than_days: int) -> None:
+
+class TootDeleter(threading.Thread):
+    """
+    Background worker deleting old toots. It uses its own connection to Mastodon and paces
+    itself using the rate limit headers returned by the Mastodon API, so that deleting a large
+    backlog of toots does not hold up posting new toots. Deleting toots has its own rate limit,
+    which is used in full, while the reserve of requests for posting toots is kept from the
+    general rate limit.
+    """
+
+    MAX_BATCH = 40
+
+    def __init__(self, config: Configuration, userinfo: dict,
+                 secrets_file: str = 'mastodon.secret') -> None:
+        super().__init__(name='TootDeleter', daemon=True)
+        self.logger = config.bot.logger
+        self.older_than_days = config.mastodon_config.delete_after
+        self.rate_reserve = config.mastodon_config.deletion_rate_reserve
+        self.idle_interval = max(config.bot.delay_between_posts, 60)
+        self.userinfo = userinfo
+        self.deletion_cursor: Optional[dict] = None
+        # Rate limits are only known once Mastodon has answered a request
+        self.api_remaining = TootDeleter.MAX_BATCH + self.rate_reserve
+        self.api_reset = 0.0
+        self.delete_remaining = TootDeleter.MAX_BATCH
+        self.delete_reset = 0.0
+        self.stop_event = threading.Event()
+        self.mastodon = Mastodon(access_token=secrets_file,
+                                 api_base_url='https://' + config.mastodon_config.domain,
+                                 ratelimit_method='throw')
+
+    def run(self) -> None:
+        """
+        Keeps deleting old toots until stop is called.
+        """
+        while not self.stop_event.is_set():
+            wait = self._budget_wait()
+            if wait == 0:
+                try:
+                    deleted = self.delete_toots(self.older_than_days, limit=self._batch_size())
+                    wait = self.idle_interval if deleted == 0 else self._budget_wait()
+                except MastodonRatelimitError:
+                    wait = max(1.0, self.mastodon.ratelimit_reset - time.time())
+                    self.logger.info('Deleting toots hit the rate limit')
+            self.logger.debug('Deleting toots continues in %.0f seconds', wait)
+            self.stop_event.wait(wait)
+
+    def stop(self) -> None:
+        """
+        Stops the worker after the current batch of deletions.
+        """
+        self.stop_event.set()
+
+    def _record_api_budget(self) -> None:
+        """
+        Keeps the general rate limit reported with the last response, which posting toots also
+        draws from.
+        """
+        self.api_remaining = self.mastodon.ratelimit_remaining
+        self.api_reset = self.mastodon.ratelimit_reset
+
+    def _record_delete_budget(self) -> None:
+        """
+        Keeps the rate limit reported with the last response to deleting a toot. Mastodon limits
+        deleting toots separately, and much more strictly, than other requests.
+        """
+        self.delete_remaining = self.mastodon.ratelimit_remaining
+        self.delete_reset = self.mastodon.ratelimit_reset
+
+    def _budget_wait(self) -> float:
+        """
+        Seconds to wait before deleting more toots. The worker waits for the general rate limit
+        window to end once only the reserve kept for posting toots is left, and for the delete
+        rate limit window to end once no deletes are left. Otherwise it carries on straight away.
+        """
+        now = time.time()
+        if self.api_remaining <= self.rate_reserve and self.api_reset > now:
+            return max(1.0, self.api_reset - now)
+        if self.delete_remaining <= 0 and self.delete_reset > now:
+            return max(1.0, self.delete_reset - now)
+        return 0
+
+    def _batch_size(self) -> int:
+        """
+        Number of toots to delete in the next batch, limited by the deletes left in the current
+        delete rate limit window.
+        """
+        if self.delete_reset > time.time():
+            return max(1, min(TootDeleter.MAX_BATCH, self.delete_remaining))
+        return TootDeleter.MAX_BATCH
+
+    def delete_toots(self, older_than_days: int, limit: int = 10) -> int:
         """
         Deletes old toots that are older than "older_than_days" days old in batches of up to
-        whatever the limit is set to in the account_statuses call to mastodon. This limit should be
-        kept low enough to not trigger rate limiting by the mastodon server.
+        "limit" toots. This limit should be kept low enough to not trigger rate limiting by the
+        mastodon server.
         For example with the limit set to 10, this method will delete up to 10 old toots and then
         return.
+        The oldest toot that is kept is remembered between calls, so that old toots can be listed
+        directly from there instead of paging through all recent toots every time.
 
         Arguments:
             older_than_days (int): This value is used to determine the most recent toot that will
                                     be considered for deletion.
+            limit (int): Maximum number of toots to delete.
+
+        Returns:
+            deleted (int): number of toots deleted
         """
+        deleted = 0
         try:
-            toots = self.mastodon.account_statuses(self.userinfo['id'], limit=10)
             now = arrow.get(arrow.now().format('YYYY-MM-DD HH:mm:ss'), 'YYYY-MM-DD HH:mm:ss')
             oldest_to_keep = now.shift(days=-older_than_days)
 
-            # List of toots is paginated. This while loop finds the first "page" of toots that
-            # contains toots old enough to need deleting
-            while True:
-                if len(toots) == 0:
-                    break
-                last_toot_created_at = arrow.get(toots[-1]['created_at'])
-                if last_toot_created_at < oldest_to_keep:
-                    break
-                max_id = toots[-1]['id']
-                self.logger.debug('Last toot in list %s from %s is not older than %s',
-                                  max_id, last_toot_created_at, oldest_to_keep)
-                toots = self.mastodon.account_statuses(self.userinfo['id'], max_id=max_id,
-                                                       limit=10)
+            if self.deletion_cursor is None or \
+                    arrow.get(self.deletion_cursor['created_at']) < oldest_to_keep:
+                self.deletion_cursor = self._find_deletion_cursor(oldest_to_keep)
+
+            max_id = self.deletion_cursor['id'] if self.deletion_cursor else None
+            toots = self.mastodon.account_statuses(self.userinfo['id'], max_id=max_id,
+                                                   limit=limit)
+            self._record_api_budget()
 
             # Actually deleting toots that are older than "older_than_days"
             for toot in toots:
@@ -276,5 +650,56 @@ class MastodonPublisher:
                 if created_at < oldest_to_keep:
                     self.logger.info('Deleting toot %s from %s', toot['url'], toot['created_at'])
                     self.mastodon.status_delete(toot['id'])
+                    self._record_delete_budget()
+                    deleted += 1
+                    if self.delete_remaining <= 0:
+                        break
+        except MastodonRatelimitError:
+            raise
         except MastodonError as mastodon_error:
             self.logger.error('Encountered error while deleting_toots: %s ', mastodon_error)
+            self.deletion_cursor = None
+        return deleted
+
+    def _find_deletion_cursor(self, oldest_to_keep: arrow.Arrow) -> Optional[dict]:
+        """
+        Finds the oldest toot that is not older than oldest_to_keep. If an earlier cursor is
+        known, only toots newer than that cursor are listed, otherwise toots are paged through
+        starting from the most recent one.
+
+        Arguments:
+            oldest_to_keep: toots created before this are to be deleted
+
+        Returns:
+            cursor: the oldest toot to keep, or None if all toots are old enough to be deleted
+        """
+        if self.deletion_cursor is not None:
+            # Walk forward in time from the earlier cursor; usually only a few toots have become
+            # old enough to delete since the last call
+            min_id = self.deletion_cursor['id']
+            while True:
+                toots = self.mastodon.account_statuses(self.userinfo['id'], min_id=min_id,
+                                                       limit=40)
+                if len(toots) == 0:
+                    return None
+                kept = [toot for toot in toots if arrow.get(toot['created_at']) >= oldest_to_keep]
+                if len(kept) > 0:
+                    self.logger.debug('Deletion cursor moved to toot %s', kept[-1]['id'])
+                    return kept[-1]
+                min_id = toots[0]['id']
+
+        # List of toots is paginated. This while loop finds the first "page" of toots that
+        # contains toots old enough to need deleting
+        cursor = None
+        max_id = None
+        while True:
+            toots = self.mastodon.account_statuses(self.userinfo['id'], max_id=max_id, limit=10)
+            for toot in toots:
+                if arrow.get(toot['created_at']) < oldest_to_keep:
+                    self.logger.debug('Deletion cursor set to toot %s',
+                                      cursor['id'] if cursor else None)
+                    return cursor
+                cursor = toot
+            if len(toots) == 0:
+                return cursor
+            max_id = toots[-1]['id']
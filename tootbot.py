@@ -12,101 +12,153 @@ from collect import RedditHelper
 from control import Configuration
 from monitoring import HealthChecks
 from publish import MastodonPublisher
+from publish import TootDeleter
 
 CODE_VERSION_MAJOR = 3  # Current major version of this code
 CODE_VERSION_MINOR = 0  # Current minor version of this code
 CODE_VERSION_PATCH = 4  # Current patch version of this code
 
-config = Configuration()
-
-# Check for updates
-try:
-    response = requests.get(
-        'https://gitlab.com/marvin8/tootbot/-/raw/main/update-check/release-version.txt')
-    response.raise_for_status()
-    repo_version = response.content.decode('utf-8').strip().partition('.')
-    repo_version_major = int(repo_version[0].strip())
-    repo_minor_version_to_check = repo_version[2].strip().partition('.')
-    if repo_minor_version_to_check[1] == '':
-        repo_version_minor = int(repo_minor_version_to_check[0].strip())
-        repo_version_patch = 0
-    else:
-        repo_version_minor = int(repo_minor_version_to_check[0].strip())
-        repo_version_patch = int(repo_minor_version_to_check[2].strip())
-
-    code_version_numeric = CODE_VERSION_MAJOR * 1000000
-    code_version_numeric += CODE_VERSION_MINOR * 1000
-    code_version_numeric += CODE_VERSION_PATCH
-    repo_version_numeric = repo_version_major * 1000000
-    repo_version_numeric += repo_version_minor * 1000
-    repo_version_numeric += repo_version_patch
-
-    if code_version_numeric >= repo_version_numeric:
-        config.bot.logger.info('Tootbot v%s.%s.%s is up to date.',
-                               CODE_VERSION_MAJOR, CODE_VERSION_MINOR, CODE_VERSION_PATCH)
-    else:
-        config.bot.logger.warning('New version of Tootbot (v%s.%s.%s) is available!',
-                                  repo_version_major, repo_version_minor, repo_version_patch)
-        config.bot.logger.warning('(You have v%s.%s.%s)',
-                                  CODE_VERSION_MAJOR, CODE_VERSION_MINOR, CODE_VERSION_PATCH)
-        config.bot.logger.warning('Latest available at: https://gitlab.com/marvin8/tootbot/')
-except (requests.exceptions.ConnectionError,
-        requests.exceptions.Timeout,
-        requests.exceptions.HTTPError) as update_check_error:
-    config.bot.logger.info('while checking for updates we got this error: %s', update_check_error)
-
-mastodon_publisher = MastodonPublisher(config=config)
-healthcheck = HealthChecks(config=config)
-reddit = RedditHelper(config=config)
-media_helper = LinkedMediaHelper(config=config)
-
-# Set the command line window title on Windows
-if os.name == 'nt':
-    try:
-        # Set title with just Mastodon username
-        os.system('title ' + mastodon_publisher.userinfo['username'] +
-                  '@' + config.mastodon_config.domain + ' - Tootbot')
-    except OSError:
-        os.system('title Tootbot')
-
-# Run the main script
-while True:
-    if config.health.enabled:
-        healthcheck.check_start()
-
-    reddit_posts = {}
-    for subreddit in config.subreddits:
-        reddit_posts[subreddit.tags] = reddit.get_reddit_posts(subreddit.name,
-                                                               limit=config.reddit.post_limit)
-    mastodon_publisher.make_post(reddit_posts, reddit, media_helper)
 
+def check_for_updates(config: Configuration) -> None:
+    """
+    Checks if a newer version of tootbot has been released.
+    """
+    try:
+        response = config.http.session.get(
+            'https://gitlab.com/marvin8/tootbot/-/raw/main/update-check/release-version.txt',
+            timeout=config.http.timeout)
+        response.raise_for_status()
+        repo_version = response.content.decode('utf-8').strip().partition('.')
+        repo_version_major = int(repo_version[0].strip())
+        repo_minor_version_to_check = repo_version[2].strip().partition('.')
+        if repo_minor_version_to_check[1] == '':
+            repo_version_minor = int(repo_minor_version_to_check[0].strip())
+            repo_version_patch = 0
+        else:
+            repo_version_minor = int(repo_minor_version_to_check[0].strip())
+            repo_version_patch = int(repo_minor_version_to_check[2].strip())
+
+        code_version_numeric = CODE_VERSION_MAJOR * 1000000
+        code_version_numeric += CODE_VERSION_MINOR * 1000
+        code_version_numeric += CODE_VERSION_PATCH
+        repo_version_numeric = repo_version_major * 1000000
+        repo_version_numeric += repo_version_minor * 1000
+        repo_version_numeric += repo_version_patch
+
+        if code_version_numeric >= repo_version_numeric:
+            config.bot.logger.info('Tootbot v%s.%s.%s is up to date.',
+                                   CODE_VERSION_MAJOR, CODE_VERSION_MINOR, CODE_VERSION_PATCH)
+        else:
+            config.bot.logger.warning('New version of Tootbot (v%s.%s.%s) is available!',
+                                      repo_version_major, repo_version_minor, repo_version_patch)
+            config.bot.logger.warning('(You have v%s.%s.%s)',
+                                      CODE_VERSION_MAJOR, CODE_VERSION_MINOR, CODE_VERSION_PATCH)
+            config.bot.logger.warning('Latest available at: https://gitlab.com/marvin8/tootbot/')
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.HTTPError) as update_check_error:
+        config.bot.logger.info('while checking for updates we got this error: %s',
+                               update_check_error)
+
+
+def main() -> None:
+    """
+    Runs tootbot until it is stopped, or only once if RunOnceOnly is set.
+    """
+    config = Configuration()
+    check_for_updates(config)
+
+    mastodon_publisher = MastodonPublisher(config=config)
+    healthcheck = HealthChecks(config=config)
+    reddit = RedditHelper(config=config)
+    media_helper = LinkedMediaHelper(config=config, media_limits=mastodon_publisher.media_limits)
+
+    # Set the command line window title on Windows
+    if os.name == 'nt':
+        try:
+            # Set title with just Mastodon username
+            os.system('title ' + mastodon_publisher.userinfo['username'] +
+                      '@' + config.mastodon_config.domain + ' - Tootbot')
+        except OSError:
+            os.system('title Tootbot')
+
+    # Old toots are deleted in the background, unless tootbot only runs once
+    toot_deleter = None
     if config.mastodon_config.delete_after > 0:
-        config.bot.logger.info('Deleting Toots older than %s days',
-                               config.mastodon_config.delete_after)
-        mastodon_publisher.delete_toots(older_than_days=config.mastodon_config.delete_after)
+        toot_deleter = TootDeleter(config=config, userinfo=mastodon_publisher.userinfo)
+        if not config.bot.run_once_only:
+            config.bot.logger.info('Deleting Toots older than %s days in the background',
+                                   config.mastodon_config.delete_after)
+            toot_deleter.start()
     else:
         config.bot.logger.info('Deleting old toots disabled')
 
-    if config.health.enabled:
-        healthcheck.check_ok()
-
-    if config.bot.run_once_only:
-        config.bot.logger.info('Exiting because RunOnceOnly is set to %s', config.bot.run_once_only)
-        sys.exit(0)
-
-    config.bot.logger.info('Sleeping for %s seconds', config.bot.delay_between_posts)
-    time.sleep(config.bot.delay_between_posts)
-
-    if config.mastodon_config.throttling_enabled:
-        extra_sleep = 1
-        sleep_time_elapsed = config.bot.delay_between_posts
-        while extra_sleep <= config.mastodon_config.number_of_errors and \
-                sleep_time_elapsed <= config.mastodon_config.throttling_max_delay:
-            if config.health.enabled:
-                healthcheck.check(data='Extra wait due to Mastodon API error')
-            config.bot.logger.info('Extra sleep #%s due to Mastodon API error(s)', extra_sleep)
-            time.sleep(config.bot.delay_between_posts)
-            sleep_time_elapsed += config.bot.delay_between_posts
-            extra_sleep += 1
-
-    config.bot.logger.info('Restarting main process...')
+    # Run the main script
+    next_cache_compaction = time.monotonic()
+    staged_post = None
+    while True:
+        if config.health.enabled:
+            healthcheck.check_start()
+
+        if config.bot.cache_retention_days > 0 and time.monotonic() >= next_cache_compaction:
+            config.bot.post_recorder.compact(retention_days=config.bot.cache_retention_days)
+            next_cache_compaction = time.monotonic() + config.bot.cache_compaction_interval * 3600
+
+        if staged_post is not None and staged_post.is_stale(config.bot.prefetch_max_age):
+            config.bot.logger.info('Post prepared earlier is out of date')
+            staged_post.attachments.destroy()
+            staged_post = None
+        if staged_post is not None:
+            reddit_posts = staged_post.posts
+        else:
+            reddit_posts = reddit.get_all_reddit_posts(config.subreddits)
+        mastodon_publisher.make_post(reddit_posts, reddit, media_helper, staged_post=staged_post)
+        staged_post = None
+
+        if toot_deleter is not None and config.bot.run_once_only:
+            config.bot.logger.info('Deleting Toots older than %s days',
+                                   config.mastodon_config.delete_after)
+            toot_deleter.delete_toots(older_than_days=config.mastodon_config.delete_after)
+
+        config.bot.post_recorder.flush()
+        config.http.cache.save()
+
+        if config.health.enabled:
+            healthcheck.check_ok()
+
+        if config.bot.run_once_only:
+            config.bot.logger.info('Exiting because RunOnceOnly is set to %s',
+                                   config.bot.run_once_only)
+            sys.exit(0)
+
+        delay = config.mastodon_config.scheduler.next_delay(config.bot.delay_between_posts)
+        config.bot.logger.info('Sleeping for %.0f seconds', delay)
+        if delay > config.bot.delay_between_posts:
+            # Keep health checks coming while waiting longer than usual
+            extra_wait = delay - config.bot.delay_between_posts
+            while extra_wait > 0:
+                if config.health.enabled:
+                    healthcheck.check(data='Extra wait due to Mastodon API error')
+                config.bot.logger.info('Extra wait of %.0f seconds due to Mastodon API error(s)',
+                                       extra_wait)
+                time.sleep(min(extra_wait, config.bot.delay_between_posts))
+                extra_wait -= config.bot.delay_between_posts
+            delay = config.bot.delay_between_posts
+        if config.bot.prefetch_enabled:
+            lead_time = min(config.bot.prefetch_lead_time, delay)
+            time.sleep(delay - lead_time)
+            prefetch_start = time.monotonic()
+            config.bot.logger.info('Preparing next post')
+            reddit_posts = reddit.get_all_reddit_posts(config.subreddits)
+            staged_post = mastodon_publisher.stage_post(reddit_posts, media_helper)
+            time.sleep(max(0.0, lead_time - (time.monotonic() - prefetch_start)))
+        else:
+            time.sleep(delay)
+
+        config.bot.logger.info('Restarting main process...')
+
+
+# Processes working on images import this module again when they start, so only run tootbot in the
+# main process
+if __name__ == '__main__':
+    main()